@@ -0,0 +1,69 @@
+import psycopg2
+import math
+
+def add_db_arguments(parser):
+    parser.add_argument ('--host', required=True)
+    parser.add_argument ('--port', default=5432, type=int)
+    parser.add_argument ('--db', required=True)
+    parser.add_argument ('--user', required=True)
+    parser.add_argument ('--password', required=True)
+
+def connect(args):
+    return psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+
+def db_config(args) -> dict:
+    return {
+        "host": args.host,
+        "port": args.port,
+        "db": args.db,
+        "username": args.user,
+        "password": args.password
+    }
+
+# Creates the month partitions (revision 104) for the last `days` days, so seeded rows land in
+# them as with dbtool.py --action partitions and not in self_contrib_record_default.
+# Does nothing on databases before revision 104
+def create_month_partitions(cursor, days):
+    cursor.execute("SELECT to_regproc('self_contrib_record_month_partition') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return
+    cursor.execute("SELECT self_contrib_record_month_partition(d::date) FROM generate_series("
+                   "date_trunc('month', (now() AT TIME ZONE 'UTC') - make_interval(days => %s)), now() AT TIME ZONE 'UTC', interval '1 month') AS d",
+                   (days, ))
+
+# Fills a throwaway database (created with dbtool.py) with synthetic users, chats and
+# contribution records spread evenly over the last `days` days
+def seed(conn, users, chats, rows, days=365):
+    cursor = conn.cursor()
+    create_month_partitions(cursor, days)
+    cursor.execute("INSERT INTO sd_user (id, title) SELECT g, 'user '||g FROM generate_series(1, %s) AS g ON CONFLICT DO NOTHING", (users, ))
+    cursor.execute("INSERT INTO chat (id, title) SELECT -g, 'chat '||g FROM generate_series(1, %s) AS g ON CONFLICT DO NOTHING", (chats, ))
+    step = float(days)*86400.0/float(max(rows, 1))
+    cursor.execute(
+        "INSERT INTO self_contrib_record (user_id, chat_id, ts, amount) "
+        "SELECT 1 + g %% %s, -(1 + (g / %s) %% %s), now() - make_interval(secs => g * %s), 1 + (g * 7919) %% 3000 "
+        "FROM generate_series(1, %s) AS g ON CONFLICT DO NOTHING",
+        (users, users, chats, step, rows))
+    conn.commit()
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.close()
+
+# Empties the bot tables including the trigger-maintained aggregates (database at revision 105 or later)
+def truncate(conn):
+    cursor = conn.cursor()
+    cursor.execute("TRUNCATE self_contrib_record, daily_contrib_rollup, user_chat_totals, chat, sd_user CASCADE")
+    conn.commit()
+    cursor.close()
+
+def percentile(values, p):
+    if len(values) < 1:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(math.ceil(p/100.0*len(ordered))) - 1))
+    return ordered[k]
+
+def format_latencies(name, values) -> str:
+    return "%-28s n=%-7d p50=%8.3fms p90=%8.3fms p99=%8.3fms max=%8.3fms" % (
+        name, len(values), percentile(values, 50)*1000.0, percentile(values, 90)*1000.0,
+        percentile(values, 99)*1000.0, percentile(values, 100)*1000.0)
@@ -0,0 +1,130 @@
+import os
+import sys
+import argparse
+import asyncio
+import random
+import time
+import bench_common
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from telegram import User, Chat
+from db_worker import DbWorkerService
+from async_db_worker import AsyncDbWorkerService
+from ysdb import YSDBot
+
+COMMANDS = {
+    "push": "/push 1200",
+    "pop": "/pop yes",
+    "mystat": "/mystat full",
+    "stat": "/stat 7",
+    "top": "/top 30",
+}
+
+# Limits high enough to never ignore a command
+NO_LIMITS = dict([(command, {"global": {"rate": 1e9, "burst": 1e9}, "chat": {"rate": 1e9, "burst": 1e9}, "user": {"rate": 1e9, "burst": 1e9}})
+    for command in ("push", "pop", "mystat", "stat")])
+
+class FakeMessage:
+    def __init__(self, text:str):
+        self.text = text
+        self.Replies:list[str] = []
+
+    async def reply_text(self, text:str, **kwargs) -> None:
+        self.Replies.append(text)
+
+# Just enough of telegram.Update for the YSDBot handlers
+class FakeUpdate:
+    def __init__(self, user_id:int, chat_id:int, text:str):
+        self.effective_user = User(user_id, "user "+str(user_id), False)
+        self.effective_chat = Chat(chat_id, Chat.SUPERGROUP, title="chat "+str(-chat_id))
+        self.message = FakeMessage(text)
+        self.effective_message = self.message
+
+    def IsError(self) -> bool:
+        for reply in self.message.Replies:
+            if reply.startswith("⛔️") or reply.startswith("❗️"):
+                return True
+        return False
+
+# Runs `calls` invocations of one command for random seeded users and chats, at most
+# `concurrency` at a time. Returns per-call latencies, wall time and the number of error replies
+async def run_command(bot:YSDBot, command:str, users:int, chats:int, calls:int, concurrency:int) -> tuple[list[float], float, int]:
+    handler = getattr(bot, command)
+    timings = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        nonlocal errors
+        update = FakeUpdate(random.randint(1, users), -random.randint(1, chats), COMMANDS[command])
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(update, None)
+            timings.append(time.perf_counter() - start)
+        if update.IsError():
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for i in range(calls)])
+    return timings, time.perf_counter() - start, errors
+
+async def run_all(namespace, users:int, chats:int) -> None:
+    config = bench_common.db_config(namespace)
+    config["pool"] = {"min": 1, "max": namespace.connections}
+    config["result_cache"] = {"ttl": namespace.cache_ttl}
+    if len(namespace.replica_host) > 0:
+        config["replica"] = {"host": namespace.replica_host, "port": namespace.replica_port,
+            "pool": {"min": 1, "max": namespace.connections}}
+    db = DbWorkerService(config)
+    async_db = AsyncDbWorkerService(db, db.MaxConnections)
+    bot = YSDBot(async_db, NO_LIMITS, [])
+    try:
+        for command in namespace.commands.split(","):
+            await run_command(bot, command, users, chats, min(20, namespace.calls), namespace.concurrency)
+            timings, elapsed, errors = await run_command(bot, command, users, chats, namespace.calls, namespace.concurrency)
+            print(bench_common.format_latencies(command, timings) + " %8.1f/s errors=%d" % (len(timings)/elapsed, errors))
+    finally:
+        async_db.Close()
+        db.Close()
+
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Handler benchmark',
+            description = '''Throughput and latency of YSDBot command handlers against a throwaway database''')
+    bench_common.add_db_arguments(parser)
+    parser.add_argument ('--rows', default=0, type=int, help='seed this many records first (0 - use existing data)')
+    parser.add_argument ('--users', default=1000, type=int)
+    parser.add_argument ('--chats', default=50, type=int)
+    parser.add_argument ('--calls', default=1000, type=int, help='calls per command')
+    parser.add_argument ('--concurrency', default=20, type=int, help='handlers running at once')
+    parser.add_argument ('--connections', default=20, type=int)
+    parser.add_argument ('--replica_host', default='', help='route reads to this streaming replica of the database')
+    parser.add_argument ('--replica_port', default=5432, type=int)
+    parser.add_argument ('--cache_ttl', default=0.0, type=float, help='result cache ttl (0 - every /stat and /top hits the DB)')
+    parser.add_argument ('--commands', default=",".join(COMMANDS.keys()))
+    parser.add_argument ('--scale', action='store_true', help='truncate and reseed for every --scale_rows x --scale_chats combination')
+    parser.add_argument ('--scale_rows', default='1000,100000,1000000,10000000')
+    parser.add_argument ('--scale_chats', default='1,10,100,1000')
+    return parser
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    random.seed(1)
+
+    if not namespace.scale:
+        if namespace.rows > 0:
+            conn = bench_common.connect(namespace)
+            bench_common.seed(conn, namespace.users, namespace.chats, namespace.rows)
+            conn.close()
+        asyncio.run(run_all(namespace, namespace.users, namespace.chats))
+        sys.exit(0)
+
+    for rows in [int(v) for v in namespace.scale_rows.split(",")]:
+        for chats in [int(v) for v in namespace.scale_chats.split(",")]:
+            conn = bench_common.connect(namespace)
+            bench_common.truncate(conn)
+            start = time.perf_counter()
+            bench_common.seed(conn, namespace.users, chats, rows)
+            conn.close()
+            print("== rows %d, chats %d, users %d (seeded in %.1fs)" % (rows, chats, namespace.users, time.perf_counter() - start))
+            asyncio.run(run_all(namespace, namespace.users, chats))
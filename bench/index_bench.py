@@ -0,0 +1,107 @@
+import sys
+import argparse
+import json
+import bench_common
+
+# Hot queries of DbWorkerService with representative parameters. %(user_id)s / %(chat_id)s
+# are picked from the seeded data, windows mirror the bot commands
+QUERIES = {
+    "GetAmountSum 7d":
+        "SELECT sum(amount) FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND ts >= now() - interval '7 days' AND ts <= now()",
+    "GetAmountSum 3600d":
+        "SELECT sum(amount) FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND ts >= now() - interval '3600 days' AND ts <= now()",
+    "SelectLastUserSelfContribs":
+        "SELECT ts, amount FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s ORDER BY ts DESC LIMIT 10",
+    "GetChatAmountSum 30d":
+        "SELECT sum(amount) FROM self_contrib_record WHERE chat_id = %(chat_id)s AND ts >= now() - interval '30 days' AND ts <= now()",
+    "GetChatActiveUserCount 30d":
+        "SELECT COUNT(DISTINCT user_id) FROM self_contrib_record WHERE chat_id = %(chat_id)s AND ts >= now() - interval '30 days' AND ts <= now() GROUP BY chat_id",
+    "GetTop 180d":
+        "SELECT u.id, u.title, sum(scr.amount) FROM self_contrib_record as scr INNER JOIN sd_user as u ON scr.user_id = u.id "
+        "WHERE ts >= now() - interval '180 days' AND ts <= now() AND chat_id = %(chat_id)s "
+        "GROUP BY u.id ORDER BY sum(scr.amount) DESC LIMIT 30 OFFSET 0",
+}
+
+def pick_params(conn) -> dict:
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, chat_id FROM self_contrib_record ORDER BY ts DESC LIMIT 1")
+    row = cursor.fetchone()
+    cursor.close()
+    if row is None:
+        raise Exception("self_contrib_record is empty, run with --rows")
+    return {"user_id": row[0], "chat_id": row[1]}
+
+def explain(conn, query, params, repeat) -> dict:
+    cursor = conn.cursor()
+    timings = []
+    plan = None
+    for i in range(repeat):
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = cursor.fetchone()[0][0]
+        timings.append(plan["Execution Time"])
+    cursor.close()
+    return {
+        "min_ms": min(timings),
+        "median_ms": sorted(timings)[len(timings)//2],
+        "node": plan["Plan"]["Node Type"],
+        "plan": plan["Plan"]
+    }
+
+def measure(conn, repeat) -> dict:
+    params = pick_params(conn)
+    result = {}
+    for name, query in QUERIES.items():
+        result[name] = explain(conn, query, params, repeat)
+    return result
+
+def print_phase(label, result):
+    print("== "+label)
+    for name, r in result.items():
+        print("%-28s min=%9.3fms median=%9.3fms top node: %s" % (name, r["min_ms"], r["median_ms"], r["node"]))
+
+def apply_migration(conn, filename):
+    with open(filename, 'r') as f:
+        sql_text = f.read()
+    cursor = conn.cursor()
+    cursor.execute(sql_text)
+    conn.commit()
+    cursor.execute("ANALYZE self_contrib_record")
+    conn.commit()
+    cursor.close()
+
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Index benchmark',
+            description = '''EXPLAIN ANALYZE timings of the hot self_contrib_record queries before and after a migration. Run against a throwaway database only''')
+    bench_common.add_db_arguments(parser)
+    parser.add_argument ('--rows', default=0, type=int, help='seed this many records first (0 - use existing data)')
+    parser.add_argument ('--users', default=1000, type=int)
+    parser.add_argument ('--chats', default=50, type=int)
+    parser.add_argument ('--repeat', default=5, type=int)
+    parser.add_argument ('--apply', default='', help='migration file to apply between "before" and "after" runs, e.g. db/r102.sql')
+    parser.add_argument ('--output', default='', help='write timings and plans as JSON')
+    return parser
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    conn = bench_common.connect(namespace)
+
+    if namespace.rows > 0:
+        print("Seeding "+str(namespace.rows)+" rows...")
+        bench_common.seed(conn, namespace.users, namespace.chats, namespace.rows)
+
+    report = {"before": measure(conn, namespace.repeat)}
+    print_phase("before", report["before"])
+
+    if len(namespace.apply) > 0:
+        print("Applying "+namespace.apply+"...")
+        apply_migration(conn, namespace.apply)
+        report["after"] = measure(conn, namespace.repeat)
+        print_phase("after", report["after"])
+        for name in QUERIES:
+            print("%-28s speedup x%.1f" % (name, report["before"][name]["median_ms"]/max(report["after"][name]["median_ms"], 0.001)))
+
+    if len(namespace.output) > 0:
+        with open(namespace.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    conn.close()
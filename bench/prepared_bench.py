@@ -0,0 +1,62 @@
+import os
+import sys
+import argparse
+import time
+from datetime import datetime, timedelta
+import bench_common
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from db_worker import DbWorkerService
+
+# Per-call latency of the hot DbWorkerService reads with plain SQL text versus prepared
+# statements. Run against a throwaway database only
+def measure(db:DbWorkerService, user_id:int, chat_id:int, calls:int) -> dict[str, list[float]]:
+    cases = {
+        "GetAmountSum": lambda now: db.GetAmountSum(user_id, chat_id, now - timedelta(days=7), now),
+        "GetAmountSums": lambda now: db.GetAmountSums(user_id, chat_id, {
+            "1": now - timedelta(days=1), "7": now - timedelta(days=7), "30": now - timedelta(days=30)}, now),
+        "SelectLastUserSelfContribs": lambda now: db.SelectLastUserSelfContribs(user_id, chat_id, 5),
+        "GetTop": lambda now: db.GetTop(chat_id, now - timedelta(days=30), now),
+        "GetChatPeriodStats": lambda now: db.GetChatPeriodStats(chat_id, now, 7, 2),
+    }
+    result = {}
+    for name, case in cases.items():
+        case(datetime.now())
+        timings = []
+        for i in range(calls):
+            start = time.perf_counter()
+            case(datetime.now())
+            timings.append(time.perf_counter() - start)
+        result[name] = timings
+    return result
+
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Prepared statements benchmark',
+            description = '''Per-call latency of DbWorkerService reads with and without prepared statements''')
+    bench_common.add_db_arguments(parser)
+    parser.add_argument ('--rows', default=0, type=int, help='seed this many records first (0 - use existing data)')
+    parser.add_argument ('--users', default=1000, type=int)
+    parser.add_argument ('--chats', default=50, type=int)
+    parser.add_argument ('--calls', default=2000, type=int)
+    return parser
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    conn = bench_common.connect(namespace)
+    if namespace.rows > 0:
+        bench_common.seed(conn, namespace.users, namespace.chats, namespace.rows)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, chat_id FROM self_contrib_record ORDER BY ts DESC LIMIT 1")
+    user_id, chat_id = cursor.fetchone()
+    conn.close()
+
+    for prepared in (False, True):
+        config = bench_common.db_config(namespace)
+        config["prepared_statements"] = prepared
+        config["pool"] = {"min": 1, "max": 1}
+        db = DbWorkerService(config)
+        print("== prepared statements " + ("on" if prepared else "off"))
+        for name, timings in measure(db, user_id, chat_id, namespace.calls).items():
+            print(bench_common.format_latencies(name, timings))
+        db.Close()
@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import rate_limit
+
+# Feeds millions of distinct chat/user ids through CommandLimits and reports the cost of a
+# check and the memory held by the limiter, which must stay flat. No database needed
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Rate limiter benchmark',
+            description = '''Per-check latency and memory of CommandLimits with many distinct ids''')
+    parser.add_argument ('--ids', default=5000000, type=int)
+    parser.add_argument ('--report_every', default=500000, type=int)
+    parser.add_argument ('--max_tracked_ids', default=100000, type=int)
+    return parser
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    limits = rate_limit.MakeCommandLimits({"max_tracked_ids": namespace.max_tracked_ids}, "push")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    last = start
+    for i in range(1, namespace.ids + 1):
+        limits.Check(i, -i)
+        if i % namespace.report_every == 0:
+            t = time.perf_counter()
+            current, peak = tracemalloc.get_traced_memory()
+            print("%10d ids: %7.0f ns/check, tracked %7d, memory %8.1f KiB (peak %8.1f KiB)" % (
+                i, (t - last)*1e9/namespace.report_every, limits.TrackedCount(), current/1024.0, peak/1024.0))
+            last = t
+    tracemalloc.stop()
+    print("total %.2fs" % (time.perf_counter() - start))
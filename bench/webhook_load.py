@@ -0,0 +1,107 @@
+import sys
+import argparse
+import asyncio
+import random
+import time
+import httpx
+import bench_common
+
+# Posts synthetic Telegram updates to a bot started with --mode webhook and measures how fast
+# they are accepted and, when --metrics_url is given, how fast the handlers get through them.
+# Replies go to the real Bot API and fail for the synthetic chats; use a test bot token.
+def make_update(update_id:int, user_id:int, chat_id:int, text:str) -> dict:
+    command = text.split(" ")[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "chat "+str(-chat_id)},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user "+str(user_id)},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        }
+    }
+
+# "push:5,stat:1" -> ["/push 1200", ..., "/stat"]
+def parse_mix(mix:str) -> list[str]:
+    result = []
+    for item in mix.split(","):
+        command, weight = item.split(":")
+        text = "/"+command
+        if command == "push":
+            text += " 1200"
+        result.extend([text] * int(weight))
+    return result
+
+def handled_count(metrics_url:str) -> int:
+    result = 0
+    for line in httpx.get(metrics_url).text.splitlines():
+        if line.startswith("ysdb_handler_seconds_count"):
+            result += int(float(line.split(" ")[-1]))
+    return result
+
+async def post_all(args, updates:list[dict]) -> tuple[list[float], int]:
+    headers = {}
+    if args.secret_token:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret_token
+    timings = []
+    errors = 0
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            update = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.post(args.url, json=update, headers=headers)
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        await asyncio.gather(*[worker(client) for i in range(args.concurrency)])
+    return timings, errors
+
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Webhook load test',
+            description = '''Feeds synthetic updates to the bot webhook''')
+    parser.add_argument ('--url', required=True, help='e.g. http://127.0.0.1:8443/ysdb')
+    parser.add_argument ('--secret_token', default='')
+    parser.add_argument ('--updates', default=5000, type=int)
+    parser.add_argument ('--concurrency', default=50, type=int, help='parallel HTTP requests')
+    parser.add_argument ('--users', default=1000, type=int)
+    parser.add_argument ('--chats', default=50, type=int)
+    parser.add_argument ('--mix', default='push:6,mystat:2,stat:1,top:1')
+    parser.add_argument ('--metrics_url', default='', help='e.g. http://127.0.0.1:9108/metrics, wait until all updates are handled')
+    parser.add_argument ('--wait_timeout', default=300.0, type=float)
+    return parser
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    texts = parse_mix(namespace.mix)
+    random.seed(1)
+    base_id = int(time.time())
+    updates = []
+    for i in range(namespace.updates):
+        updates.append(make_update(base_id + i,
+            random.randint(1, namespace.users), -random.randint(1, namespace.chats), random.choice(texts)))
+
+    handled_before = handled_count(namespace.metrics_url) if namespace.metrics_url else 0
+    start = time.perf_counter()
+    timings, errors = asyncio.run(post_all(namespace, updates))
+    posted = time.perf_counter() - start
+    print(bench_common.format_latencies("webhook POST", timings))
+    print("posted %d updates in %.2fs (%.1f/s), errors %d" % (len(timings), posted, len(timings)/posted, errors))
+
+    if namespace.metrics_url:
+        target = handled_before + len(timings) - errors
+        handled = handled_before
+        while handled < target and time.perf_counter() - start < namespace.wait_timeout:
+            time.sleep(0.2)
+            handled = handled_count(namespace.metrics_url)
+        elapsed = time.perf_counter() - start
+        print("handled %d updates in %.2fs (%.1f/s)" % (handled - handled_before, elapsed, (handled - handled_before)/elapsed))
@@ -0,0 +1,77 @@
+import os
+import sys
+import argparse
+import threading
+import time
+import bench_common
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from db_worker import DbWorkerService
+
+# Inserts rows from concurrent threads, once through the one-row-per-commit path and once
+# through the write-behind queue, and compares throughput. Run against a throwaway database only.
+# Every thread writes for its own users: rows of one user inserted at the same moment would
+# collide on (user_id, ts) and be dropped, and the modes would not insert the same rows
+def run(db:DbWorkerService, threads:int, rows_per_thread:int, users:int, chats:int) -> float:
+    users_per_thread = users // threads
+    def worker(index):
+        for i in range(rows_per_thread):
+            db.InsertSelfContribRecord(1 + index*users_per_thread + i % users_per_thread, -(1 + index % chats), 100)
+
+    workers = [threading.Thread(target=worker, args=(i, )) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if not (db.WriteBehind is None):
+        db.WriteBehind.Flush()
+    return time.perf_counter() - start
+
+def createParser():
+    parser = argparse.ArgumentParser(
+            prog = 'Write-behind benchmark',
+            description = '''Throughput of one-row-per-commit inserts versus the write-behind queue''')
+    bench_common.add_db_arguments(parser)
+    parser.add_argument ('--threads', default=16, type=int)
+    parser.add_argument ('--rows', default=2000, type=int, help='rows per thread')
+    parser.add_argument ('--users', default=1000, type=int)
+    parser.add_argument ('--chats', default=50, type=int)
+    parser.add_argument ('--max_delay_ms', default=20, type=int)
+    parser.add_argument ('--max_batch', default=500, type=int)
+    return parser
+
+def count_records(conn) -> int:
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM self_contrib_record")
+    result = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    return result
+
+if __name__ == '__main__':
+    namespace = createParser().parse_args(sys.argv[1:])
+    if namespace.users < 2*namespace.threads:
+        print("--users must be at least 2 x --threads, every thread writes for its own users")
+        sys.exit(1)
+    conn = bench_common.connect(namespace)
+    bench_common.seed(conn, namespace.users, namespace.chats, 0)
+
+    total = namespace.threads*namespace.rows
+    config = bench_common.db_config(namespace)
+    failed = False
+    for name, write_behind in [("one row per commit", None),
+            ("write-behind", {"enabled": True, "max_delay_ms": namespace.max_delay_ms, "max_batch": namespace.max_batch})]:
+        if not (write_behind is None):
+            config["write_behind"] = write_behind
+        before = count_records(conn)
+        db = DbWorkerService(config)
+        elapsed = run(db, namespace.threads, namespace.rows, namespace.users, namespace.chats)
+        db.Close()
+        inserted = count_records(conn) - before
+        print("%-19s %d rows in %.2fs, %.0f rows/s" % (name+":", total, elapsed, total/elapsed))
+        if inserted != total:
+            print("    inserted %d rows instead of %d" % (inserted, total))
+            failed = True
+    conn.close()
+    sys.exit(1 if failed else 0)
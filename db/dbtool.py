@@ -1,10 +1,12 @@
 import psycopg2
+import psycopg2.errors
 import sys
 import argparse
 import os
 import re
 import string
 import random
+import time
 
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
@@ -59,6 +61,180 @@ def execute_file_and_update_db_version(conn, filename, version):
         raise e 
 
 
+DIRECTIVE_PATTERN = re.compile(r"^\s*--\s*ysdb:\s*([a-z_-]+)\s*$", re.MULTILINE)
+DOLLAR_QUOTE_PATTERN = re.compile(r"\$([A-Za-z_][A-Za-z_0-9]*)?\$")
+COMMENT_PATTERN = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+CONCURRENT_INDEX_PATTERN = re.compile(r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?([A-Za-z0-9_.\"]+)", re.IGNORECASE)
+
+# Splits SQL text into statements on semicolons outside of quotes, dollar quotes and comments.
+# Returns (statement, directives) pairs; directives are the "-- ysdb: <name>" comments on their
+# own lines before the statement's first token. Directive-like text inside strings, dollar
+# quotes or the statement itself is ignored
+def split_sql(text):
+    chunks = []
+    start = 0
+    directives = set()
+    code_seen = False
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "'" or c == '"':
+            end = text.find(c, i + 1)
+            i = n if end < 0 else end + 1
+            code_seen = True
+        elif text.startswith("--", i):
+            end = text.find("\n", i)
+            end = n if end < 0 else end
+            if not code_seen and len(text[text.rfind("\n", 0, i) + 1:i].strip()) < 1:
+                m = DIRECTIVE_PATTERN.match(text[i:end])
+                if not (m is None):
+                    directives.add(m.group(1))
+            i = end + 1
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+        elif c == "$":
+            m = DOLLAR_QUOTE_PATTERN.match(text, i)
+            if m is None:
+                i += 1
+            else:
+                end = text.find(m.group(0), m.end())
+                i = n if end < 0 else end + len(m.group(0))
+            code_seen = True
+        elif c == ";":
+            chunks.append((text[start:i], directives))
+            i += 1
+            start = i
+            directives = set()
+            code_seen = False
+        else:
+            if not c.isspace():
+                code_seen = True
+            i += 1
+    chunks.append((text[start:], directives))
+
+    result = []
+    for chunk, chunk_directives in chunks:
+        if len(COMMENT_PATTERN.sub("", chunk).strip()) < 1:
+            continue
+        result.append((chunk.strip(), chunk_directives))
+    return result
+
+def file_directives(sql_text):
+    result = set()
+    for statement, directives in split_sql(sql_text):
+        result |= directives
+    return result
+
+def print_statement(index, statement, directives):
+    lines = [line for line in COMMENT_PATTERN.sub("", statement).strip().splitlines() if len(line.strip()) > 0]
+    print("  ["+str(index)+"]"+(" (batch)" if "batch" in directives else "")+" "+lines[0].strip()+(" ..." if len(lines) > 1 else ""))
+
+# A CREATE INDEX CONCURRENTLY that fails (e.g. on lock timeout while waiting for old transactions)
+# leaves an INVALID index behind, and a retry then fails or, with IF NOT EXISTS, keeps it.
+# Drops such an index; DROP INDEX CONCURRENTLY doesn't block writers, so it runs without lock_timeout
+def drop_invalid_index(cursor, name, args):
+    cursor.execute("SELECT NOT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s)", (name, ))
+    row = cursor.fetchone()
+    if row is None or not row[0]:
+        return
+    print("    dropping invalid index "+name)
+    cursor.execute("SET lock_timeout = 0")
+    try:
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS "+name)
+    finally:
+        cursor.execute("SET lock_timeout = %s", (args.lock_timeout, ))
+
+# Runs one statement in autocommit mode. Lock timeouts are retried (an invalid index left by
+# CREATE INDEX CONCURRENTLY is dropped first); "batch" statements are repeated until they
+# affect no rows
+def execute_online_statement(cursor, statement, directives, args):
+    m = CONCURRENT_INDEX_PATTERN.match(COMMENT_PATTERN.sub("", statement))
+    index_name = None if m is None else m.group(1)
+    total = 0
+    batch = 0
+    start = time.monotonic()
+    while True:
+        attempt = 0
+        while True:
+            try:
+                if not (index_name is None):
+                    drop_invalid_index(cursor, index_name, args)
+                cursor.execute(statement)
+                break
+            except psycopg2.errors.LockNotAvailable as e:
+                attempt += 1
+                if attempt > args.lock_retries:
+                    if not (index_name is None):
+                        drop_invalid_index(cursor, index_name, args)
+                    raise e
+                print("    lock timeout, retry "+str(attempt)+"/"+str(args.lock_retries))
+                time.sleep(args.retry_delay)
+        if not ("batch" in directives):
+            return
+        batch += 1
+        if cursor.rowcount < 1:
+            break
+        total += cursor.rowcount
+        elapsed = max(time.monotonic() - start, 0.001)
+        print("    batch "+str(batch)+": "+str(cursor.rowcount)+" rows, total "+str(total)+", "+str(int(total/elapsed))+" rows/s")
+        if args.batch_pause > 0:
+            time.sleep(args.batch_pause)
+    print("    done: "+str(total)+" rows in "+str(batch)+" batches")
+
+# Files marked "-- ysdb: no-transaction" run statement by statement in autocommit mode, which
+# allows CREATE INDEX CONCURRENTLY and batched backfills; a failure leaves the statements before
+# it applied, so such files must be safe to re-run. Other files run in one transaction as before.
+# Every statement waits for locks at most --lock_timeout and is retried --lock_retries times
+def apply_migration(conn, filename, version, args):
+    with open(filename, 'r') as f:
+        sql_text = f.read()
+    statements = split_sql(sql_text)
+    online = "no-transaction" in file_directives(sql_text)
+
+    if args.dry_run:
+        print("Revision "+str(version)+" ("+filename+"), "+("no-transaction" if online else "single transaction")+
+              ", lock_timeout "+args.lock_timeout+":")
+        for index, (statement, directives) in enumerate(statements):
+            print_statement(index + 1, statement, directives)
+        return
+
+    if not online:
+        attempt = 0
+        while True:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SET LOCAL lock_timeout = %s", (args.lock_timeout, ))
+                cursor.close()
+                execute_file_and_update_db_version(conn, filename, version)
+                return
+            except psycopg2.errors.LockNotAvailable as e:
+                attempt += 1
+                if attempt > args.lock_retries:
+                    raise e
+                print("    lock timeout, retry "+str(attempt)+"/"+str(args.lock_retries))
+                time.sleep(args.retry_delay)
+
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET lock_timeout = %s", (args.lock_timeout, ))
+        for index, (statement, directives) in enumerate(statements):
+            print_statement(index + 1, statement, directives)
+            execute_online_statement(cursor, statement, directives, args)
+        set_db_version(conn, version)
+        cursor.execute("RESET lock_timeout")
+        cursor.close()
+    except BaseException as e:
+        print("Exception caused on update db to revision: "+str(version)+ " (file "+filename+"), statements before the failed one are applied")
+        print("Exception message: "+str(e))
+        raise e
+    finally:
+        conn.autocommit = False
+
+
 def create_user(conn, login, password):
         cursor = conn.cursor()
         cursor.execute("CREATE USER "+login+" WITH encrypted password '"+password+"'")
@@ -103,6 +279,10 @@ def generate_password():
     return gen_random_string(password_charset, 16)
 
 def create_db(args):
+    if args.dry_run:
+        print("--dry_run is supported by --action update only")
+        return
+
     conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port)
     cursor = conn.cursor()
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT);
@@ -122,7 +302,7 @@ def create_db(args):
     for key in sorted(files):
         print("Executing file "+files[key]+ ", revision "+str(key))
         try:
-            execute_file_and_update_db_version(conn, files[key], key)
+            apply_migration(conn, files[key], key, args)
             last_revision = key
         except BaseException as e:
             print("Exception: "+str(e))
@@ -156,14 +336,366 @@ def update_db(args):
     last_revision = get_db_version(conn)
     for key in sorted(files):
         print("Executing file "+files[key]+ ", revision "+str(key))
-        execute_file_and_update_db_version(conn, files[key], key)
+        apply_migration(conn, files[key], key, args)
         last_revision = key
 
+    if args.dry_run:
+        print("Dry run, nothing applied. Revision: "+str(get_db_version(conn)))
+        return
     print("Database updated. Revision: "+str(last_revision))    
 
     return
 
 
+def rebuild_rollup(args):
+    conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+
+    print("Rebuilding daily_contrib_rollup...")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("LOCK TABLE self_contrib_record IN SHARE MODE")
+        cursor.execute("DELETE FROM daily_contrib_rollup")
+        cursor.execute("INSERT INTO daily_contrib_rollup (chat_id, user_id, day, amount, record_count) "
+                       "SELECT chat_id, user_id, (ts AT TIME ZONE 'UTC')::date, sum(amount), count(*) "
+                       "FROM self_contrib_record GROUP BY chat_id, user_id, (ts AT TIME ZONE 'UTC')::date")
+        row_count = cursor.rowcount
+        cursor.close()
+        conn.commit()
+    except BaseException as e:
+        print("Exception caused on rebuilding daily_contrib_rollup")
+        print("Exception message: "+str(e))
+        conn.rollback()
+        raise e
+
+    print("Rollup rebuilt. Rows: "+str(row_count))
+
+    return
+
+
+def list_month_partitions(conn):
+    pattern = re.compile("^self_contrib_record_y([0-9]{4})m([0-9]{2})$")
+    cursor = conn.cursor()
+    cursor.execute("SELECT c.relname FROM pg_inherits i INNER JOIN pg_class c ON c.oid = i.inhrelid "
+                   "WHERE i.inhparent = 'self_contrib_record'::regclass")
+    result = []
+    for row in cursor.fetchall():
+        m = pattern.match(row[0])
+        if m:
+            result.append((int(m.group(1)), int(m.group(2)), row[0]))
+    cursor.close()
+    return sorted(result)
+
+# Creates the partition of the month starting at month_day. Rows of that month already in the
+# default partition would make CREATE TABLE ... PARTITION OF fail, so they are moved: default is
+# detached, the month partition created, the rows copied into it and deleted from default, and
+# default attached back. Aggregates don't change, so their triggers are off for the move.
+# Runs in the caller's transaction
+def create_month_partition(cursor, month_day):
+    bounds = {"month_day": month_day}
+    where = "ts >= %(month_day)s::date::timestamp AT TIME ZONE 'UTC' AND ts < (%(month_day)s::date + interval '1 month')::timestamp AT TIME ZONE 'UTC'"
+    cursor.execute("SELECT count(*) FROM self_contrib_record_default WHERE "+where, bounds)
+    default_rows = cursor.fetchone()[0]
+    if default_rows < 1:
+        cursor.execute("SELECT self_contrib_record_month_partition(%s)", (month_day, ))
+        return cursor.fetchone()[0]
+
+    cursor.execute("ALTER TABLE self_contrib_record DETACH PARTITION self_contrib_record_default")
+    cursor.execute("SELECT self_contrib_record_month_partition(%s)", (month_day, ))
+    name = cursor.fetchone()[0]
+    for trigger in AGGREGATE_TRIGGERS:
+        cursor.execute("ALTER TABLE self_contrib_record DISABLE TRIGGER "+trigger)
+    cursor.execute("INSERT INTO self_contrib_record (user_id, chat_id, ts, amount) "
+                   "SELECT user_id, chat_id, ts, amount FROM self_contrib_record_default WHERE "+where, bounds)
+    cursor.execute("DELETE FROM self_contrib_record_default WHERE "+where, bounds)
+    for trigger in AGGREGATE_TRIGGERS:
+        cursor.execute("ALTER TABLE self_contrib_record ENABLE TRIGGER "+trigger)
+    cursor.execute("ALTER TABLE self_contrib_record ATTACH PARTITION self_contrib_record_default DEFAULT")
+    return name+" ("+str(default_rows)+" rows moved from self_contrib_record_default)"
+
+def manage_partitions(args):
+    conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+
+    try:
+        cursor = conn.cursor()
+        # months ahead, plus every month that already has rows in the default partition
+        cursor.execute("SELECT (date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => g))::date "
+                       "FROM generate_series(0, %s) AS g "
+                       "UNION SELECT DISTINCT date_trunc('month', ts AT TIME ZONE 'UTC')::date FROM self_contrib_record_default "
+                       "ORDER BY 1", (args.months_ahead, ))
+        months = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+        print("Creating partitions for "+str(args.months_ahead)+" months ahead...")
+        skipped = 0
+        for month_day in months:
+            try:
+                print("    "+create_month_partition(cursor, month_day))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                skipped += 1
+                print("    Skipped "+month_day.strftime("%Y-%m")+": "+str(e).strip())
+        if skipped > 0:
+            print("Warning: "+str(skipped)+" months skipped, their records stay in self_contrib_record_default")
+
+        if args.detach_older_than > 0:
+            cursor.execute("SELECT extract(year FROM d)::int, extract(month FROM d)::int "
+                           "FROM (SELECT date_trunc('month', now() AT TIME ZONE 'UTC') - make_interval(months => %s) AS d) AS x",
+                           (args.detach_older_than, ))
+            limit = tuple(cursor.fetchone())
+            for year, month, name in list_month_partitions(conn):
+                if (year, month) >= limit:
+                    continue
+                print("Detaching "+name+("" if args.drop_detached else " (kept as a standalone table)"))
+                cursor.execute("ALTER TABLE self_contrib_record DETACH PARTITION "+name)
+                if args.drop_detached:
+                    cursor.execute("DROP TABLE "+name)
+                conn.commit()
+        cursor.close()
+    except BaseException as e:
+        print("Exception caused on managing partitions")
+        print("Exception message: "+str(e))
+        conn.rollback()
+        raise e
+
+    print("Partitions:")
+    for year, month, name in list_month_partitions(conn):
+        print("    "+name)
+
+    return
+
+
+COPY_TABLES = {
+    "sd_user": "id bigint, title varchar(200)",
+    "chat": "id bigint, title varchar(200)",
+    "self_contrib_record": "user_id bigint, chat_id bigint, ts timestamptz, amount int"
+}
+
+AGGREGATE_TRIGGERS = ["trg_self_contrib_record_rollup", "trg_self_contrib_record_totals"]
+
+def copy_file_name(args, table):
+    return os.path.join(args.dir, table+(".csv" if args.format == "csv" else ".bin"))
+
+def copy_options(args):
+    if args.format == "csv":
+        return "(FORMAT csv, HEADER true)"
+    return "(FORMAT binary)"
+
+# WHERE condition on self_contrib_record columns (optionally prefixed) built from --chat_id/--since/--until
+def record_filter(cursor, args, prefix=""):
+    conditions = ["true"]
+    if args.chat_id != 0:
+        conditions.append(cursor.mogrify(prefix+"chat_id = %s", (args.chat_id, )).decode())
+    if len(args.since) > 0:
+        conditions.append(cursor.mogrify(prefix+"ts >= %s::timestamptz", (args.since, )).decode())
+    if len(args.until) > 0:
+        conditions.append(cursor.mogrify(prefix+"ts < %s::timestamptz", (args.until, )).decode())
+    return " AND ".join(conditions)
+
+def export_data(args):
+    conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    os.makedirs(args.dir, exist_ok=True)
+
+    cursor = conn.cursor()
+    cursor.execute("SET TIME ZONE 'UTC'")
+    records = "SELECT user_id, chat_id, ts, amount FROM self_contrib_record WHERE "+record_filter(cursor, args)
+    queries = {
+        "sd_user": "SELECT id, title FROM sd_user",
+        "chat": "SELECT id, title FROM chat",
+        "self_contrib_record": records
+    }
+    if args.chat_id != 0 or len(args.since) > 0 or len(args.until) > 0:
+        queries["sd_user"] += " WHERE id IN (SELECT user_id FROM ("+records+") AS r)"
+        queries["chat"] += " WHERE id IN (SELECT chat_id FROM ("+records+") AS r)"
+
+    print("Exporting to "+args.dir+" ("+args.format+")...")
+    for table, query in queries.items():
+        start = time.monotonic()
+        with open(copy_file_name(args, table), "wb") as f:
+            cursor.copy_expert("COPY ("+query+") TO STDOUT WITH "+copy_options(args), f)
+        elapsed = max(time.monotonic() - start, 0.001)
+        print("    "+table+": "+str(cursor.rowcount)+" rows, "+str(int(cursor.rowcount/elapsed))+" rows/s")
+    cursor.close()
+    conn.rollback()
+    conn.close()
+
+    return
+
+# Everything is loaded into temporary staging tables with COPY and merged in one transaction.
+# Records conflicting on (user_id, ts) are skipped or overwritten (--on_conflict). With --bulk the
+# rollup/totals triggers are disabled for the merge (this locks self_contrib_record exclusively)
+# and the affected aggregate rows are recomputed afterwards, which is much faster for large files
+def import_data(args):
+    conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+
+    print("Importing from "+args.dir+" ("+args.format+")...")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET TIME ZONE 'UTC'")
+        for table, columns in COPY_TABLES.items():
+            start = time.monotonic()
+            cursor.execute("CREATE TEMP TABLE import_"+table+" ("+columns+") ON COMMIT DROP")
+            with open(copy_file_name(args, table), "rb") as f:
+                cursor.copy_expert("COPY import_"+table+" FROM STDIN WITH "+copy_options(args), f)
+            elapsed = max(time.monotonic() - start, 0.001)
+            print("    loaded "+table+": "+str(cursor.rowcount)+" rows, "+str(int(cursor.rowcount/elapsed))+" rows/s")
+
+        cursor.execute("DELETE FROM import_self_contrib_record WHERE NOT ("+record_filter(cursor, args)+")")
+        cursor.execute("ANALYZE import_self_contrib_record")
+
+        title_action = "DO UPDATE SET title = EXCLUDED.title" if args.on_conflict == "update" else "DO NOTHING"
+        for table, column in (("sd_user", "user_id"), ("chat", "chat_id")):
+            cursor.execute("INSERT INTO "+table+" (id, title) SELECT id, title FROM import_"+table+
+                           " WHERE id IN (SELECT "+column+" FROM import_self_contrib_record) ON CONFLICT (id) "+title_action)
+            print("    merged "+table+": "+str(cursor.rowcount)+" rows")
+
+        if args.bulk:
+            # aggregate keys touched by the import, including the old chat/day of overwritten records
+            cursor.execute("CREATE TEMP TABLE import_keys ON COMMIT DROP AS "
+                           "SELECT user_id, chat_id, (ts AT TIME ZONE 'UTC')::date AS day FROM import_self_contrib_record "
+                           "UNION SELECT s.user_id, s.chat_id, (s.ts AT TIME ZONE 'UTC')::date "
+                           "FROM self_contrib_record AS s INNER JOIN import_self_contrib_record AS i ON s.user_id = i.user_id AND s.ts = i.ts")
+            for trigger in AGGREGATE_TRIGGERS:
+                cursor.execute("ALTER TABLE self_contrib_record DISABLE TRIGGER "+trigger)
+
+        start = time.monotonic()
+        record_action = "DO UPDATE SET chat_id = EXCLUDED.chat_id, amount = EXCLUDED.amount" if args.on_conflict == "update" else "DO NOTHING"
+        cursor.execute("INSERT INTO self_contrib_record (user_id, chat_id, ts, amount) "
+                       "SELECT user_id, chat_id, ts, amount FROM import_self_contrib_record ON CONFLICT (user_id, ts) "+record_action)
+        elapsed = max(time.monotonic() - start, 0.001)
+        print("    merged self_contrib_record: "+str(cursor.rowcount)+" rows, "+str(int(cursor.rowcount/elapsed))+" rows/s")
+
+        if args.bulk:
+            for trigger in AGGREGATE_TRIGGERS:
+                cursor.execute("ALTER TABLE self_contrib_record ENABLE TRIGGER "+trigger)
+            cursor.execute("DELETE FROM daily_contrib_rollup AS r USING (SELECT DISTINCT chat_id, day FROM import_keys) AS k "
+                           "WHERE r.chat_id = k.chat_id AND r.day = k.day")
+            cursor.execute("INSERT INTO daily_contrib_rollup (chat_id, user_id, day, amount, record_count) "
+                           "SELECT s.chat_id, s.user_id, k.day, sum(s.amount), count(*) "
+                           "FROM (SELECT DISTINCT chat_id, day FROM import_keys) AS k INNER JOIN self_contrib_record AS s ON s.chat_id = k.chat_id "
+                           "AND s.ts >= k.day::timestamp AT TIME ZONE 'UTC' AND s.ts < (k.day + 1)::timestamp AT TIME ZONE 'UTC' "
+                           "GROUP BY s.chat_id, s.user_id, k.day")
+            print("    recomputed daily_contrib_rollup: "+str(cursor.rowcount)+" rows")
+            cursor.execute("DELETE FROM user_chat_totals AS t USING (SELECT DISTINCT user_id, chat_id FROM import_keys) AS k "
+                           "WHERE t.user_id = k.user_id AND t.chat_id = k.chat_id")
+            cursor.execute("INSERT INTO user_chat_totals (user_id, chat_id, total, record_count, first_ts, last_ts) "
+                           "SELECT s.user_id, s.chat_id, sum(s.amount), count(*), min(s.ts), max(s.ts) "
+                           "FROM (SELECT DISTINCT user_id, chat_id FROM import_keys) AS k INNER JOIN self_contrib_record AS s "
+                           "ON s.user_id = k.user_id AND s.chat_id = k.chat_id GROUP BY s.user_id, s.chat_id")
+            print("    recomputed user_chat_totals: "+str(cursor.rowcount)+" rows")
+
+        cursor.close()
+        conn.commit()
+    except BaseException as e:
+        print("Exception caused on importing data")
+        print("Exception message: "+str(e))
+        conn.rollback()
+        raise e
+
+    print("Import finished")
+
+    return
+
+
+# Longest window any bot query reads from raw rows: /stat 180 compares two 180-day periods
+COMPACT_MIN_DAYS = 366
+
+COMPACT_SQL = """WITH groups AS (
+    SELECT user_id, chat_id, (ts AT TIME ZONE 'UTC')::date AS day
+    FROM self_contrib_record
+    WHERE user_id = ANY(%(user_ids)s) AND ts < %(cutoff)s
+    GROUP BY user_id, chat_id, (ts AT TIME ZONE 'UTC')::date
+    HAVING count(*) > 1
+), deleted AS (
+    DELETE FROM self_contrib_record AS s USING groups AS g
+    WHERE s.user_id = g.user_id AND s.chat_id = g.chat_id AND s.ts < %(cutoff)s
+        AND s.ts >= g.day::timestamp AT TIME ZONE 'UTC' AND s.ts < (g.day + 1)::timestamp AT TIME ZONE 'UTC'
+    RETURNING s.user_id, s.chat_id, s.ts, s.amount
+), inserted AS (
+    INSERT INTO self_contrib_record (user_id, chat_id, ts, amount)
+    SELECT user_id, chat_id, min(ts), sum(amount)::int
+    FROM deleted
+    GROUP BY user_id, chat_id, (ts AT TIME ZONE 'UTC')::date
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM deleted), (SELECT count(*) FROM inserted)"""
+
+# Exact row count (reltuples is 0 on a table that has not been analyzed yet) and total size
+def record_table_stats(cursor):
+    cursor.execute("SELECT (SELECT count(*) FROM self_contrib_record), "
+                   "(SELECT coalesce(sum(pg_total_relation_size(c.oid)), 0)::bigint "
+                   "FROM pg_inherits AS i INNER JOIN pg_class AS c ON c.oid = i.inhrelid "
+                   "WHERE i.inhparent = 'self_contrib_record'::regclass)")
+    return cursor.fetchone()
+
+def format_bytes(value):
+    return str(round(value/1024.0/1024.0, 1))+" MB"
+
+# Merges the records of every (user, chat, UTC day) older than --older_than days into one record
+# with the day's first ts and the total amount. One transaction per --batch_users users; the rollup
+# and totals triggers see a delete and an insert of the same amount, so aggregates do not change.
+# Queries over windows starting after the cutoff return exactly the same results, hence the minimum
+def compact_records(args):
+    if args.older_than < COMPACT_MIN_DAYS and not args.force:
+        print("--older_than must be at least "+str(COMPACT_MIN_DAYS)+" days (the longest query window), use --force to override")
+        return
+
+    conn = psycopg2.connect(user=args.user, password = args.password, host=args.host, port = args.port, database = args.db)
+    cursor = conn.cursor()
+    cursor.execute("SELECT date_trunc('day', now() AT TIME ZONE 'UTC' - make_interval(days => %s)) AT TIME ZONE 'UTC'", (args.older_than, ))
+    cutoff = cursor.fetchone()[0]
+    cursor.execute("SELECT id FROM sd_user ORDER BY id")
+    user_ids = [row[0] for row in cursor.fetchall()]
+    rows_before, bytes_before = record_table_stats(cursor)
+    conn.commit()
+
+    print("Compacting records older than "+str(cutoff)+" for "+str(len(user_ids))+" users...")
+    deleted_total = 0
+    inserted_total = 0
+    start = time.monotonic()
+    for first in range(0, len(user_ids), args.batch_users):
+        batch = user_ids[first:first + args.batch_users]
+        try:
+            cursor.execute(COMPACT_SQL, {"user_ids": batch, "cutoff": cutoff})
+            deleted, inserted = cursor.fetchone()
+            conn.commit()
+        except BaseException as e:
+            print("Exception caused on compacting users "+str(batch[0])+".."+str(batch[-1]))
+            print("Exception message: "+str(e))
+            conn.rollback()
+            raise e
+        deleted_total += deleted
+        inserted_total += inserted
+        if deleted > 0:
+            elapsed = max(time.monotonic() - start, 0.001)
+            print("    users "+str(first + len(batch))+"/"+str(len(user_ids))+": "+str(deleted)+" -> "+str(inserted)+
+                  " rows, total "+str(deleted_total)+" -> "+str(inserted_total)+", "+str(int(deleted_total/elapsed))+" rows/s")
+        if args.batch_pause > 0:
+            time.sleep(args.batch_pause)
+
+    if args.vacuum:
+        print("Vacuuming...")
+        conn.autocommit = True
+        cursor.execute("VACUUM (ANALYZE) self_contrib_record")
+        conn.autocommit = False
+    else:
+        cursor.execute("ANALYZE self_contrib_record")
+        conn.commit()
+
+    rows_after, bytes_after = record_table_stats(cursor)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    print("Records merged: "+str(deleted_total)+" -> "+str(inserted_total)+" (reclaimed "+str(deleted_total - inserted_total)+" rows)")
+    print("Table rows: "+str(rows_before)+" -> "+str(rows_after))
+    print("Table size: "+format_bytes(bytes_before)+" -> "+format_bytes(bytes_after)+
+          ("" if args.vacuum else " (space of deleted rows is reused after autovacuum or --vacuum)"))
+
+    return
+
+
 def truncate_db(args):
     print ("not implemented")
     return
@@ -181,8 +713,27 @@ def createParser():
     parser.add_argument ('--db', required=True)
     parser.add_argument ('--user', required=True)
     parser.add_argument ('--password', required=True)
-    parser.add_argument ('--action', choices=['create', 'update', 'truncate'], default='create')
+    parser.add_argument ('--action', choices=['create', 'update', 'truncate', 'rebuild-rollup', 'partitions', 'export', 'import', 'compact'], default='create')
     parser.add_argument ('--all_access_for', default='')
+    parser.add_argument ('--months_ahead', default=3, type=int, help='partitions: months to pre-create')
+    parser.add_argument ('--detach_older_than', default=0, type=int, help='partitions: detach month partitions older than N months (0 - keep all)')
+    parser.add_argument ('--drop_detached', action='store_true', help='partitions: drop detached partitions instead of keeping them as archive tables')
+    parser.add_argument ('--lock_timeout', default='5s', help='create/update: lock_timeout of every migration statement')
+    parser.add_argument ('--lock_retries', default=20, type=int, help='create/update: retries of a statement that hit lock_timeout')
+    parser.add_argument ('--retry_delay', default=1.0, type=float, help='create/update: seconds between lock retries')
+    parser.add_argument ('--batch_pause', default=0.0, type=float, help='create/update/compact: seconds between batches (of "-- ysdb: batch" statements or compacted users)')
+    parser.add_argument ('--dry_run', action='store_true', help='update: print the statements of pending migrations without running them')
+    parser.add_argument ('--older_than', default=0, type=int, help='compact: merge records older than N days into one per user, chat and day')
+    parser.add_argument ('--force', action='store_true', help='compact: allow --older_than below the longest query window')
+    parser.add_argument ('--batch_users', default=50, type=int, help='compact: users per transaction')
+    parser.add_argument ('--vacuum', action='store_true', help='compact: VACUUM the table afterwards')
+    parser.add_argument ('--dir', default='.', help='export/import: directory with sd_user, chat and self_contrib_record files')
+    parser.add_argument ('--format', choices=['csv', 'binary'], default='csv', help='export/import: COPY format')
+    parser.add_argument ('--chat_id', default=0, type=int, help='export/import: only records of this chat')
+    parser.add_argument ('--since', default='', help='export/import: only records with ts >= this timestamp')
+    parser.add_argument ('--until', default='', help='export/import: only records with ts < this timestamp')
+    parser.add_argument ('--on_conflict', choices=['skip', 'update'], default='skip', help='import: records with an existing (user_id, ts)')
+    parser.add_argument ('--bulk', action='store_true', help='import: disable aggregate triggers and recompute affected aggregates afterwards')
  
     return parser
  
@@ -197,6 +748,16 @@ if __name__ == '__main__':
         update_db(namespace)
     elif (namespace.action == "truncate"):
         truncate_db(namespace)
+    elif (namespace.action == "rebuild-rollup"):
+        rebuild_rollup(namespace)
+    elif (namespace.action == "partitions"):
+        manage_partitions(namespace)
+    elif (namespace.action == "export"):
+        export_data(namespace)
+    elif (namespace.action == "import"):
+        import_data(namespace)
+    elif (namespace.action == "compact"):
+        compact_records(namespace)
     else:
         print ("impossible case")
 
@@ -0,0 +1,5 @@
+CREATE INDEX idx_self_contrib_record_chat_ts on self_contrib_record ("chat_id", "ts") INCLUDE ("user_id", "amount");
+CREATE INDEX idx_self_contrib_record_user_chat_ts on self_contrib_record ("user_id", "chat_id", "ts" DESC) INCLUDE ("amount");
+
+DROP INDEX idx_self_contrib_record_chat_id;
+DROP INDEX idx_self_contrib_record_ts;
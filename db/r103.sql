@@ -0,0 +1,36 @@
+CREATE TABLE daily_contrib_rollup (
+    chat_id bigint NOT NULL,
+    user_id bigint NOT NULL,
+    day date NOT NULL,
+    amount bigint NOT NULL,
+    record_count int NOT NULL,
+    PRIMARY KEY (chat_id, day, user_id)
+);
+
+CREATE FUNCTION daily_contrib_rollup_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE daily_contrib_rollup
+            SET amount = amount - OLD.amount, record_count = record_count - 1
+            WHERE chat_id = OLD.chat_id AND day = (OLD.ts AT TIME ZONE 'UTC')::date AND user_id = OLD.user_id;
+        DELETE FROM daily_contrib_rollup
+            WHERE chat_id = OLD.chat_id AND day = (OLD.ts AT TIME ZONE 'UTC')::date AND user_id = OLD.user_id AND record_count <= 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO daily_contrib_rollup (chat_id, user_id, day, amount, record_count)
+            VALUES (NEW.chat_id, NEW.user_id, (NEW.ts AT TIME ZONE 'UTC')::date, NEW.amount, 1)
+            ON CONFLICT (chat_id, day, user_id) DO UPDATE
+            SET amount = daily_contrib_rollup.amount + EXCLUDED.amount, record_count = daily_contrib_rollup.record_count + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_self_contrib_record_rollup
+    AFTER INSERT OR UPDATE OR DELETE ON self_contrib_record
+    FOR EACH ROW EXECUTE FUNCTION daily_contrib_rollup_apply();
+
+INSERT INTO daily_contrib_rollup (chat_id, user_id, day, amount, record_count)
+    SELECT chat_id, user_id, (ts AT TIME ZONE 'UTC')::date, sum(amount), count(*)
+    FROM self_contrib_record
+    GROUP BY chat_id, user_id, (ts AT TIME ZONE 'UTC')::date;
@@ -0,0 +1,53 @@
+CREATE FUNCTION self_contrib_record_month_partition(month_day date) RETURNS text AS $$
+DECLARE
+    month_start date := date_trunc('month', month_day)::date;
+    part_name text := 'self_contrib_record_y' || to_char(month_start, 'YYYY') || 'm' || to_char(month_start, 'MM');
+BEGIN
+    IF to_regclass(part_name) IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF self_contrib_record FOR VALUES FROM (%L) TO (%L)',
+            part_name,
+            month_start::timestamp AT TIME ZONE 'UTC',
+            (month_start + interval '1 month')::timestamp AT TIME ZONE 'UTC');
+    END IF;
+    RETURN part_name;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE self_contrib_record RENAME TO self_contrib_record_unpartitioned;
+DROP TRIGGER trg_self_contrib_record_rollup ON self_contrib_record_unpartitioned;
+
+CREATE TABLE self_contrib_record (
+    user_id bigint NOT NULL,
+    ts timestamp with time zone NOT NULL DEFAULT now(),
+    chat_id bigint NOT NULL,
+    amount int NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES sd_user (id),
+    FOREIGN KEY (chat_id) REFERENCES chat (id)
+) PARTITION BY RANGE (ts);
+
+CREATE TABLE self_contrib_record_default PARTITION OF self_contrib_record DEFAULT;
+
+DO $$
+DECLARE
+    month_day date;
+BEGIN
+    month_day := date_trunc('month', coalesce((SELECT (min(ts) AT TIME ZONE 'UTC')::date FROM self_contrib_record_unpartitioned), current_date))::date;
+    WHILE month_day <= current_date + interval '3 months' LOOP
+        PERFORM self_contrib_record_month_partition(month_day);
+        month_day := month_day + interval '1 month';
+    END LOOP;
+END;
+$$;
+
+INSERT INTO self_contrib_record (user_id, ts, chat_id, amount)
+    SELECT user_id, ts, chat_id, amount FROM self_contrib_record_unpartitioned;
+
+DROP TABLE self_contrib_record_unpartitioned;
+
+ALTER TABLE self_contrib_record ADD PRIMARY KEY (user_id, ts);
+CREATE INDEX idx_self_contrib_record_chat_ts on self_contrib_record ("chat_id", "ts") INCLUDE ("user_id", "amount");
+CREATE INDEX idx_self_contrib_record_user_chat_ts on self_contrib_record ("user_id", "chat_id", "ts" DESC) INCLUDE ("amount");
+
+CREATE TRIGGER trg_self_contrib_record_rollup
+    AFTER INSERT OR UPDATE OR DELETE ON self_contrib_record
+    FOR EACH ROW EXECUTE FUNCTION daily_contrib_rollup_apply();
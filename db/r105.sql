@@ -0,0 +1,45 @@
+CREATE TABLE user_chat_totals (
+    user_id bigint NOT NULL,
+    chat_id bigint NOT NULL,
+    total bigint NOT NULL,
+    record_count int NOT NULL,
+    first_ts timestamp with time zone NOT NULL,
+    last_ts timestamp with time zone NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE FUNCTION user_chat_totals_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_chat_totals
+            SET total = total - OLD.amount, record_count = record_count - 1
+            WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id;
+        -- AFTER row triggers see the statement's changes, so the removed row is already gone here
+        UPDATE user_chat_totals AS t
+            SET first_ts = coalesce((SELECT min(ts) FROM self_contrib_record WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id), t.first_ts),
+                last_ts = coalesce((SELECT max(ts) FROM self_contrib_record WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id), t.last_ts)
+            WHERE t.user_id = OLD.user_id AND t.chat_id = OLD.chat_id AND (t.first_ts = OLD.ts OR t.last_ts = OLD.ts);
+        DELETE FROM user_chat_totals
+            WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id AND record_count <= 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO user_chat_totals (user_id, chat_id, total, record_count, first_ts, last_ts)
+            VALUES (NEW.user_id, NEW.chat_id, NEW.amount, 1, NEW.ts, NEW.ts)
+            ON CONFLICT (user_id, chat_id) DO UPDATE
+            SET total = user_chat_totals.total + EXCLUDED.total,
+                record_count = user_chat_totals.record_count + 1,
+                first_ts = least(user_chat_totals.first_ts, EXCLUDED.first_ts),
+                last_ts = greatest(user_chat_totals.last_ts, EXCLUDED.last_ts);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_self_contrib_record_totals
+    AFTER INSERT OR UPDATE OR DELETE ON self_contrib_record
+    FOR EACH ROW EXECUTE FUNCTION user_chat_totals_apply();
+
+INSERT INTO user_chat_totals (user_id, chat_id, total, record_count, first_ts, last_ts)
+    SELECT user_id, chat_id, sum(amount), count(*), min(ts), max(ts)
+    FROM self_contrib_record
+    GROUP BY user_id, chat_id;
@@ -0,0 +1,67 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from db_worker import DbWorkerService, ChatRelatedUserSelfContrib, ChatTopItem, ChatPeriodStat, PushResult, PopResult, UserChatTotal
+
+# Awaitable facade over DbWorkerService. Every call runs the synchronous psycopg2
+# method on a bounded thread pool, so a slow query only occupies one worker thread
+# instead of freezing the whole event loop. The executor is never larger than the
+# connection pool, so workers do not compete for pooled connections.
+class AsyncDbWorkerService:
+    def __init__(self, db:DbWorkerService, max_workers:int):
+        self.Db = db
+        self.ResultCache = db.ResultCache
+        self.Executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ysdb-db")
+
+    async def Run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.Executor, functools.partial(func, *args, **kwargs))
+
+    def Close(self) -> None:
+        self.Executor.shutdown(wait=True)
+
+    async def EnsureUserExists(self, user_id:int, title:str) -> None:
+        return await self.Run(self.Db.EnsureUserExists, user_id, title)
+
+    async def EnsureChatExists(self, chat_id:int, title:str) -> None:
+        return await self.Run(self.Db.EnsureChatExists, chat_id, title)
+
+    async def InsertSelfContribRecord(self, user_id:int, chat_id:int, amount:int) -> None:
+        return await self.Run(self.Db.InsertSelfContribRecord, user_id, chat_id, amount)
+
+    async def PushContribution(self, user_id:int, user_title:str, chat_id:int, chat_title:str, amount:int, day_limit:int, now_ts:datetime) -> PushResult:
+        return await self.Run(self.Db.PushContribution, user_id, user_title, chat_id, chat_title, amount, day_limit, now_ts)
+
+    async def DeleteLastSelfContribRecords(self, user_id:int, chat_id:int, limit:int, remaining_count:int = 5) -> PopResult:
+        return await self.Run(self.Db.DeleteLastSelfContribRecords, user_id, chat_id, limit, remaining_count)
+
+    async def SelectLastUserSelfContribs(self, user_id:int, chat_id:int, limit:int) -> list[ChatRelatedUserSelfContrib]:
+        return await self.Run(self.Db.SelectLastUserSelfContribs, user_id, chat_id, limit)
+
+    async def GetAllAmountSum(self, user_id:int) -> int:
+        return await self.Run(self.Db.GetAllAmountSum, user_id)
+
+    async def GetUserChatTotals(self, user_id:int) -> list[UserChatTotal]:
+        return await self.Run(self.Db.GetUserChatTotals, user_id)
+
+    async def GetAmountSum(self, user_id:int, chat_id:int, start_ts:datetime, end_ts:datetime) -> int:
+        return await self.Run(self.Db.GetAmountSum, user_id, chat_id, start_ts, end_ts)
+
+    async def GetAmountSums(self, user_id:int, chat_id:int, windows:dict[str, datetime|None], end_ts:datetime) -> dict[str, int]:
+        return await self.Run(self.Db.GetAmountSums, user_id, chat_id, windows, end_ts)
+
+    async def GetChatAmountSum(self, chat_id:int, start_ts:datetime, end_ts:datetime) -> int:
+        return await self.Run(self.Db.GetChatAmountSum, chat_id, start_ts, end_ts)
+
+    async def GetChatActiveUserCount(self, chat_id:int, start_ts:datetime, end_ts:datetime) -> int:
+        return await self.Run(self.Db.GetChatActiveUserCount, chat_id, start_ts, end_ts)
+
+    async def GetChatPeriodStats(self, chat_id:int, now_ts:datetime, day_count:int, periods:int = 2) -> list[ChatPeriodStat]:
+        return await self.Run(self.Db.GetChatPeriodStats, chat_id, now_ts, day_count, periods)
+
+    async def GetActiveChatIds(self, since_ts:datetime) -> list[int]:
+        return await self.Run(self.Db.GetActiveChatIds, since_ts)
+
+    async def GetTop(self, chat_id:int, start_ts:datetime, end_ts:datetime) -> list[ChatTopItem]:
+        return await self.Run(self.Db.GetTop, chat_id, start_ts, end_ts)
@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from ysdb_exception import YSDBException
+
+class ConnectionInfo:
+    def __init__(self, created:float):
+        self.Created = created
+        self.LastUsed = created
+
+# Thread-safe replacement for psycopg2's ThreadedConnectionPool with the same getconn/putconn API.
+# When all max_size connections are busy, callers wait (at most max_waiting of them, at most
+# wait_timeout seconds each) instead of failing at once. Connections that are closed, left in a
+# broken transaction or older than max_age are discarded on return, and connections idle for
+# longer than check_idle_after are pinged before being handed out.
+class ManagedConnectionPool:
+    def __init__(self, connect, config:dict):
+        self.Connect = connect
+        self.MinSize = config.get("min", 5)
+        self.MaxSize = config.get("max", 20)
+        self.MaxWaiting = config.get("max_waiting", 100)
+        self.WaitTimeout = config.get("wait_timeout", 5.0)
+        self.MaxAge = config.get("max_age", 3600.0)
+        self.CheckIdleAfter = config.get("check_idle_after", 30.0)
+
+        self.Idle:list = []
+        self.Infos:dict[int, ConnectionInfo] = {}
+        self.InUse = 0
+        self.Opening = 0
+        self.Waiting = 0
+        self.Created = 0
+        self.Discarded = 0
+        self.Timeouts = 0
+        self.Rejected = 0
+        self.Closed = False
+        self.Condition = threading.Condition()
+
+        for i in range(self.MinSize):
+            conn = self.Open()
+            with self.Condition:
+                self.Idle.append(conn)
+
+    def Open(self):
+        conn = self.Connect()
+        with self.Condition:
+            self.Infos[id(conn)] = ConnectionInfo(time.monotonic())
+            self.Created += 1
+        return conn
+
+    def Size(self) -> int:
+        return len(self.Idle) + self.InUse + self.Opening
+
+    # Returns an idle connection, or None when the caller has reserved a slot to open a new one
+    def Take(self, deadline:float):
+        with self.Condition:
+            while True:
+                if self.Closed:
+                    raise YSDBException("connection pool is closed")
+                if len(self.Idle) > 0:
+                    self.InUse += 1
+                    return self.Idle.pop()
+                if self.Size() < self.MaxSize:
+                    self.Opening += 1
+                    return None
+                if self.Waiting >= self.MaxWaiting:
+                    self.Rejected += 1
+                    raise YSDBException("🕓 База данных перегружена, попробуйте чуть позже")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.Timeouts += 1
+                    raise YSDBException("🕓 База данных не ответила вовремя, попробуйте чуть позже")
+                self.Waiting += 1
+                try:
+                    self.Condition.wait(remaining)
+                finally:
+                    self.Waiting -= 1
+
+    def getconn(self):
+        deadline = time.monotonic() + self.WaitTimeout
+        while True:
+            conn = self.Take(deadline)
+            if conn is None:
+                try:
+                    conn = self.Open()
+                except BaseException:
+                    with self.Condition:
+                        self.Opening -= 1
+                        self.Condition.notify()
+                    raise
+                with self.Condition:
+                    self.Opening -= 1
+                    self.InUse += 1
+                return conn
+
+            if self.IsAlive(conn):
+                return conn
+            with self.Condition:
+                self.InUse -= 1
+            self.Discard(conn)
+
+    def IsAlive(self, conn) -> bool:
+        if conn.closed:
+            return False
+        info = self.Infos.get(id(conn))
+        now = time.monotonic()
+        if info is None or now - info.Created > self.MaxAge:
+            return False
+        if now - info.LastUsed > self.CheckIdleAfter:
+            try:
+                ps_cursor = conn.cursor()
+                ps_cursor.execute("SELECT 1")
+                ps_cursor.fetchall()
+                conn.rollback()
+            except BaseException as ex:
+                logging.warning("[POOL] Dropping dead connection: "+str(ex))
+                return False
+        return True
+
+    def putconn(self, conn, close:bool = False) -> None:
+        with self.Condition:
+            self.InUse -= 1
+
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except BaseException:
+                    close = True
+
+        info = self.Infos.get(id(conn))
+        now = time.monotonic()
+        if close or conn.closed or self.Closed or info is None or now - info.Created > self.MaxAge:
+            self.Discard(conn)
+            return
+
+        with self.Condition:
+            info.LastUsed = now
+            self.Idle.append(conn)
+            self.Condition.notify()
+
+    def Discard(self, conn) -> None:
+        try:
+            if not conn.closed:
+                conn.close()
+        except BaseException:
+            pass
+        with self.Condition:
+            self.Infos.pop(id(conn), None)
+            self.Discarded += 1
+            self.Condition.notify()
+
+    def closeall(self) -> None:
+        with self.Condition:
+            self.Closed = True
+            idle = self.Idle
+            self.Idle = []
+            self.Condition.notify_all()
+        for conn in idle:
+            self.Discard(conn)
+
+    def GetStats(self) -> dict[str, int]:
+        with self.Condition:
+            return {
+                "in_use": self.InUse,
+                "idle": len(self.Idle),
+                "waiting": self.Waiting,
+                "created": self.Created,
+                "discarded": self.Discarded,
+                "timeouts": self.Timeouts,
+                "rejected": self.Rejected
+            }
+
+    def GetStatText(self) -> str:
+        return ", ".join([k+" "+str(v) for k, v in self.GetStats().items()])
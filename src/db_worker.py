@@ -1,85 +1,489 @@
 import psycopg2
 import psycopg2.extras
-from psycopg2 import pool
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import inspect
+import logging
+import threading
+import time
 from ysdb_exception import YSDBException
+from write_behind import WriteBehindQueue
+from result_cache import ResultCache
+from metrics import METRICS, ROWS_BUCKETS
+from db_pool import ManagedConnectionPool
+from prepared import PreparingConnection, Statement, StatementFamily
+
+def CountRows(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 1
+
+def RunWithConnection(pool, labels:tuple, function_to_decorate, args, kwargs):
+    start = time.perf_counter()
+    conn = pool.getconn()
+    acquired = time.perf_counter()
+    METRICS.Observe("ysdb_db_pool_wait_seconds", labels, acquired - start)
+    kwargs['connection'] = conn
+    try:
+        result = function_to_decorate(*args, **kwargs)
+        METRICS.Observe("ysdb_db_rows", labels, CountRows(result), ROWS_BUCKETS)
+        return result
+    finally:
+        METRICS.Observe("ysdb_db_query_seconds", labels, time.perf_counter() - acquired)
+        pool.putconn(conn)
 
 def ConnectionPool(function_to_decorate):    
+    labels = (("method", function_to_decorate.__name__), ("pool", "primary"))
     def wrapper(*args, **kwargs):
-        obj = args[0]
-        conn = obj.Pool.getconn()
-        kwargs['connection'] = conn
-        try:
-            return function_to_decorate(*args, **kwargs)
-        finally:
-            obj.Pool.putconn(conn)     
+        return RunWithConnection(args[0].Pool, labels, function_to_decorate, args, kwargs)
         
     return wrapper
 
+# For read-only methods: runs on the replica pool when one is configured, unless the method's
+# user_id argument belongs to a user who wrote within the pin window (read-your-writes), or its
+# chat_id to a chat written to within it, so chat-wide results cached after the write's
+# invalidation are never taken from a lagging replica.
+# Connection failures and recovery conflicts on the replica are retried on the primary
+def ReadConnectionPool(function_to_decorate):
+    signature = inspect.signature(function_to_decorate)
+    primary_labels = (("method", function_to_decorate.__name__), ("pool", "primary"))
+    replica_labels = (("method", function_to_decorate.__name__), ("pool", "replica"))
+    def wrapper(*args, **kwargs):
+        obj = args[0]
+        if not (obj.ReplicaPool is None) and not obj.IsPinned(signature.bind_partial(*args, **kwargs).arguments):
+            try:
+                return RunWithConnection(obj.ReplicaPool, replica_labels, function_to_decorate, args, dict(kwargs))
+            except psycopg2.OperationalError as ex:
+                logging.warning("[REPLICA] %s failed on replica, retrying on primary: %s", function_to_decorate.__name__, ex)
+        return RunWithConnection(obj.Pool, primary_labels, function_to_decorate, args, kwargs)
+
+    return wrapper
+
+# (user_id, amount) rows of one chat within [start_ts, end_ts]. Whole UTC days inside the
+# interval are read from daily_contrib_rollup, only the partial first and last days come
+# from the raw self_contrib_record rows
+CHAT_ROWS_SQL = """WITH bounds AS (
+    SELECT d_from, d_to,
+        d_from::timestamp AT TIME ZONE 'UTC' AS full_from,
+        greatest(d_from, d_to)::timestamp AT TIME ZONE 'UTC' AS full_to
+    FROM (SELECT (%(start_ts)s::timestamptz AT TIME ZONE 'UTC')::date + 1 AS d_from,
+        (%(end_ts)s::timestamptz AT TIME ZONE 'UTC')::date AS d_to) AS d
+), chat_rows AS (
+    SELECT r.user_id, r.amount FROM bounds, daily_contrib_rollup AS r
+    WHERE r.chat_id = %(chat_id)s AND r.day >= bounds.d_from AND r.day < bounds.d_to
+    UNION ALL
+    SELECT s.user_id, s.amount FROM bounds, self_contrib_record AS s
+    WHERE s.chat_id = %(chat_id)s AND s.ts >= %(start_ts)s AND s.ts <= %(end_ts)s AND s.ts < bounds.full_from
+    UNION ALL
+    SELECT s.user_id, s.amount FROM bounds, self_contrib_record AS s
+    WHERE s.chat_id = %(chat_id)s AND s.ts >= %(start_ts)s AND s.ts <= %(end_ts)s AND s.ts >= bounds.full_to
+) """
+
+UPSERT_USER = Statement("upsert_user", {"user_id": "bigint", "user_title": "varchar"},
+    "INSERT INTO sd_user (id, title) VALUES (%(user_id)s, %(user_title)s) ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title WHERE sd_user.title <> EXCLUDED.title")
+
+UPSERT_CHAT = Statement("upsert_chat", {"chat_id": "bigint", "chat_title": "varchar"},
+    "INSERT INTO chat (id, title) VALUES (%(chat_id)s, %(chat_title)s) ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title WHERE chat.title <> EXCLUDED.title")
+
+INSERT_RECORD = Statement("insert_record", {"user_id": "bigint", "chat_id": "bigint", "amount": "int"},
+    "INSERT INTO self_contrib_record (user_id, chat_id, amount) VALUES (%(user_id)s, %(chat_id)s, %(amount)s)")
+
+PUSH_LOCK = Statement("push_lock", {"user_id": "bigint"}, "SELECT pg_advisory_xact_lock(%(user_id)s)")
+
+PUSH_CONTRIBUTION = Statement("push_contribution", {
+        "user_id": "bigint", "chat_id": "bigint", "amount": "int", "day_limit": "bigint",
+        "day_start": "timestamptz", "week_start": "timestamptz"},
+    """WITH sums AS (
+    SELECT coalesce(sum(amount) FILTER (WHERE ts >= %(day_start)s), 0) AS day_amount, coalesce(sum(amount), 0) AS week_amount
+    FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND ts >= %(week_start)s
+), ins AS (
+    INSERT INTO self_contrib_record (user_id, chat_id, amount)
+    SELECT %(user_id)s, %(chat_id)s, %(amount)s FROM sums WHERE sums.day_amount <= %(day_limit)s
+    RETURNING amount
+)
+SELECT (SELECT count(*) FROM ins), sums.day_amount, sums.week_amount FROM sums""")
+
+# Deletes the last `limit` records of the user in the chat by key and, in the same statement, returns
+# them (is_deleted = true) together with up to `remaining` newest records left after the deletion.
+# The outer SELECT sees the table as it was before the DELETE, hence the exclusion of deleted rows
+POP_LAST = Statement("pop_last", {"user_id": "bigint", "chat_id": "bigint", "limit": "bigint", "remaining": "bigint"},
+    "WITH deleted AS ("
+    "DELETE FROM self_contrib_record WHERE (user_id, ts) IN ("
+    "SELECT user_id, ts FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s ORDER BY ts DESC LIMIT %(limit)s) "
+    "RETURNING ts, amount) "
+    "SELECT true, ts, amount FROM deleted "
+    "UNION ALL "
+    "(SELECT false, ts, amount FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s "
+    "AND ts NOT IN (SELECT ts FROM deleted) ORDER BY ts DESC LIMIT %(remaining)s)")
+
+SELECT_LAST = Statement("select_last", {"user_id": "bigint", "chat_id": "bigint", "limit": "bigint"},
+    "SELECT ts, amount FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s ORDER BY ts DESC LIMIT %(limit)s")
+
+AMOUNT_SUM = Statement("amount_sum", {"user_id": "bigint", "chat_id": "bigint", "start_ts": "timestamptz", "end_ts": "timestamptz"},
+    "SELECT sum(amount) FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND ts >= %(start_ts)s AND ts <= %(end_ts)s")
+
+# One statement per (number of windows, with all-time total): w0..wN are the window starts, from_ts
+# the earliest of them. The all-time total is read from user_chat_totals instead of scanning history
+def BuildAmountSums(key:tuple[int, bool]) -> Statement:
+    window_count, with_total = key
+    param_types = {"user_id": "bigint", "chat_id": "bigint"}
+    columns = []
+    for i in range(window_count):
+        param_types["w"+str(i)] = "timestamptz"
+        columns.append("sum(amount) FILTER (WHERE ts >= %(w"+str(i)+")s)")
+    if with_total:
+        columns.append("(SELECT total FROM user_chat_totals WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s)")
+    sql = "SELECT "+", ".join(columns)
+    if window_count > 0:
+        param_types["from_ts"] = "timestamptz"
+        param_types["end_ts"] = "timestamptz"
+        sql += " FROM self_contrib_record WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND ts >= %(from_ts)s AND ts <= %(end_ts)s"
+    return Statement("amount_sums_"+str(window_count)+("_total" if with_total else ""), param_types, sql)
+
+AMOUNT_SUMS = StatementFamily(BuildAmountSums)
+
+ALL_AMOUNT_SUM = Statement("all_amount_sum", {"user_id": "bigint"},
+    "SELECT sum(total)::bigint FROM user_chat_totals WHERE user_id = %(user_id)s")
+
+USER_CHAT_TOTALS = Statement("user_chat_totals", {"user_id": "bigint"},
+    "SELECT t.chat_id, c.title, t.total, t.record_count, t.first_ts, t.last_ts "
+    "FROM user_chat_totals AS t INNER JOIN chat AS c ON t.chat_id = c.id "
+    "WHERE t.user_id = %(user_id)s ORDER BY t.total DESC")
+
+CHAT_ROWS_TYPES = {"chat_id": "bigint", "start_ts": "timestamptz", "end_ts": "timestamptz"}
+
+CHAT_AMOUNT_SUM = Statement("chat_amount_sum", CHAT_ROWS_TYPES, CHAT_ROWS_SQL + "SELECT sum(amount)::bigint FROM chat_rows")
+
+CHAT_ACTIVE_USER_COUNT = Statement("chat_active_user_count", CHAT_ROWS_TYPES, CHAT_ROWS_SQL + "SELECT COUNT(DISTINCT user_id) FROM chat_rows")
+
+CHAT_TOP = Statement("chat_top", CHAT_ROWS_TYPES,
+    CHAT_ROWS_SQL + "SELECT u.id, u.title, sum(cr.amount)::bigint "
+    "FROM chat_rows as cr INNER JOIN sd_user as u ON cr.user_id = u.id "
+    "GROUP BY u.id ORDER BY sum(cr.amount) DESC LIMIT 30 OFFSET 0")
+
+ACTIVE_CHAT_IDS = Statement("active_chat_ids", {"since_day": "date"},
+    "SELECT DISTINCT chat_id FROM daily_contrib_rollup WHERE day >= %(since_day)s")
+
+# LRU of ids already registered in the DB together with the title stored there.
+# A hit with the same title means the row is up to date and no query is needed
+class KnownIdCache:
+    def __init__(self, max_size:int):
+        self.MaxSize = max_size
+        self.Items:OrderedDict[int, str] = OrderedDict()
+        self.Lock = threading.Lock()
+
+    def IsKnown(self, id:int, title:str) -> bool:
+        with self.Lock:
+            known_title = self.Items.get(id)
+            if known_title is None:
+                return False
+            if known_title != title:
+                del self.Items[id]
+                return False
+            self.Items.move_to_end(id)
+            return True
+
+    def Add(self, id:int, title:str) -> None:
+        with self.Lock:
+            self.Items[id] = title
+            self.Items.move_to_end(id)
+            while len(self.Items) > self.MaxSize:
+                self.Items.popitem(last=False)
+
+# Total amount and distinct writers of one chat for `periods` consecutive periods of `day_count`
+# days ending at now_ts, period 0 being the latest. Days containing a period boundary (including
+# the first and the last day) are read from raw rows, every other day from daily_contrib_rollup
+CHAT_PERIOD_STATS_SQL = """WITH params AS (
+    SELECT %(now_ts)s::timestamptz AS now_ts,
+        make_interval(secs => %(day_count)s * 86400) AS period,
+        %(now_ts)s::timestamptz - make_interval(secs => %(day_count)s * %(periods)s * 86400) AS start_ts
+), edges AS (
+    SELECT DISTINCT ((p.now_ts - p.period * k) AT TIME ZONE 'UTC')::date AS day
+    FROM params AS p, generate_series(0, %(periods)s) AS k
+), chat_rows AS (
+    SELECT r.user_id, r.amount, r.day::timestamp AT TIME ZONE 'UTC' AS ts
+    FROM params AS p, daily_contrib_rollup AS r
+    WHERE r.chat_id = %(chat_id)s AND r.day > (p.start_ts AT TIME ZONE 'UTC')::date AND r.day < (p.now_ts AT TIME ZONE 'UTC')::date
+        AND r.day NOT IN (SELECT day FROM edges)
+    UNION ALL
+    SELECT s.user_id, s.amount, s.ts
+    FROM params AS p, edges AS e, self_contrib_record AS s
+    WHERE s.chat_id = %(chat_id)s AND s.ts >= e.day::timestamp AT TIME ZONE 'UTC' AND s.ts < (e.day + 1)::timestamp AT TIME ZONE 'UTC'
+        AND s.ts >= p.start_ts AND s.ts <= p.now_ts
+)
+SELECT least(floor(extract(epoch FROM p.now_ts - cr.ts) / extract(epoch FROM p.period))::int, %(periods)s - 1) AS period_index,
+    sum(cr.amount)::bigint, count(DISTINCT cr.user_id)
+FROM params AS p, chat_rows AS cr
+GROUP BY period_index"""
+
+CHAT_PERIOD_STATS = Statement("chat_period_stats", {"chat_id": "bigint", "now_ts": "timestamptz", "day_count": "int", "periods": "int"},
+    CHAT_PERIOD_STATS_SQL)
+
 class ChatRelatedUserSelfContrib:
     def __init__(self, ts:datetime, amount:int):
         self.TS = ts
         self.Amount = amount
 
+class PushResult:
+    def __init__(self, accepted:bool, day_amount:int, week_amount:int):
+        self.Accepted = accepted
+        self.DayAmount = day_amount
+        self.WeekAmount = week_amount
+
+class PopResult:
+    def __init__(self, deleted:list[ChatRelatedUserSelfContrib], remaining:list[ChatRelatedUserSelfContrib]):
+        self.Deleted = deleted
+        self.Remaining = remaining
+
+class ChatPeriodStat:
+    def __init__(self, start_ts:datetime, end_ts:datetime, amount:int, writer_count:int):
+        self.StartTS = start_ts
+        self.EndTS = end_ts
+        self.Amount = amount
+        self.WriterCount = writer_count
+
 class ChatTopItem:
     def __init__(self, title:str, amount:int):
         self.Title = title
         self.Amount = amount        
 
+class UserChatTotal:
+    def __init__(self, chat_id:int, title:str, total:int, record_count:int, first_ts:datetime, last_ts:datetime):
+        self.ChatId = chat_id
+        self.Title = title
+        self.Total = total
+        self.RecordCount = record_count
+        self.FirstTS = first_ts
+        self.LastTS = last_ts
+
+# Users (or chats) who wrote within the last `window` seconds; their reads stay on the primary
+class RecentWriters:
+    def __init__(self, window:float):
+        self.Window = window
+        self.Deadlines:OrderedDict[int, float] = OrderedDict()
+        self.Lock = threading.Lock()
+
+    def Mark(self, user_id:int) -> None:
+        now = time.monotonic()
+        with self.Lock:
+            self.Deadlines[user_id] = now + self.Window
+            self.Deadlines.move_to_end(user_id)
+            while len(self.Deadlines) > 0:
+                first_id, deadline = next(iter(self.Deadlines.items()))
+                if deadline > now:
+                    break
+                del self.Deadlines[first_id]
+
+    def IsPinned(self, user_id:int|None) -> bool:
+        if user_id is None:
+            return False
+        with self.Lock:
+            deadline = self.Deadlines.get(user_id)
+        return not (deadline is None) and deadline > time.monotonic()
+
 class DbWorkerService:   
     def __init__(self, config:dict):
         psycopg2.extras.register_uuid()
-        self.Pool = psycopg2.pool.ThreadedConnectionPool(
-            5, 20,
-            user = config["username"],
-            password = config["password"],
-            host = config["host"],
-            port = config["port"],
-            database = config["db"])       
+        self.ConnectParams = {
+            "user": config["username"],
+            "password": config["password"],
+            "host": config["host"],
+            "port": config["port"],
+            "database": config["db"]}
+        self.UsePreparedStatements = config.get("prepared_statements", True)
+        self.Pool = ManagedConnectionPool(
+            lambda: psycopg2.connect(connection_factory=PreparingConnection, **self.ConnectParams), config.get("pool", {}))
+        self.MaxConnections = self.Pool.MaxSize
+        METRICS.RegisterGauge("ysdb_db_pool_connections", lambda: dict(
+            [((("pool", "primary"), ("state", k)), v) for k, v in self.Pool.GetStats().items()]))
 
-        
-    @ConnectionPool    
-    def EnsureUserExists(self, user_id:int, title:str,  connection=None) -> None:
-        ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id FROM sd_user WHERE id = %s", (user_id, ))        
-        rows = ps_cursor.fetchall()
-        if len(rows) < 1:            
-            ps_cursor.execute("INSERT INTO sd_user (id, title) VALUES (%s, %s)", (user_id, title)) 
-            connection.commit()
-        
+        # Optional streaming replica for reads; missing connection settings are taken from the primary
+        self.ReplicaPool = None
+        replica_conf = config.get("replica", {})
+        self.RecentWriters = RecentWriters(replica_conf.get("pin_seconds", 5.0))
+        self.RecentChats = RecentWriters(replica_conf.get("pin_seconds", 5.0))
+        if len(replica_conf.get("host", "")) > 0:
+            self.ReplicaConnectParams = dict(self.ConnectParams)
+            self.ReplicaConnectParams.update({
+                "user": replica_conf.get("username", config["username"]),
+                "password": replica_conf.get("password", config["password"]),
+                "host": replica_conf["host"],
+                "port": replica_conf.get("port", config["port"]),
+                "database": replica_conf.get("db", config["db"])})
+            self.ReplicaPool = ManagedConnectionPool(
+                lambda: psycopg2.connect(connection_factory=PreparingConnection, **self.ReplicaConnectParams), replica_conf.get("pool", config.get("pool", {})))
+            METRICS.RegisterGauge("ysdb_db_replica_pool_connections", lambda: dict(
+                [((("pool", "replica"), ("state", k)), v) for k, v in self.ReplicaPool.GetStats().items()]))
 
-    @ConnectionPool    
-    def EnsureChatExists(self, chat_id:int, title:str, connection=None) -> None:
-        ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id FROM chat WHERE id = %s", (chat_id, ))        
-        rows = ps_cursor.fetchall()
-        if len(rows) < 1:            
-            ps_cursor.execute("INSERT INTO chat (id, title) VALUES (%s, %s)", (chat_id, title)) 
-            connection.commit()   
+        self.KnownUsers = KnownIdCache(config.get("known_id_cache_size", 10000))
+        self.KnownChats = KnownIdCache(config.get("known_id_cache_size", 10000))
+
+        result_cache_conf = config.get("result_cache", {})
+        self.ResultCache = ResultCache(result_cache_conf.get("ttl", 10.0), result_cache_conf.get("max_size", 2000))
+        METRICS.RegisterGauge("ysdb_result_cache_hits", lambda: {(): self.ResultCache.Hits})
+        METRICS.RegisterGauge("ysdb_result_cache_misses", lambda: {(): self.ResultCache.Misses})
+        METRICS.RegisterGauge("ysdb_result_cache_entries", lambda: {(): len(self.ResultCache.Items)})
+
+        self.WriteBehind = None
+        write_behind_conf = config.get("write_behind", {})
+        if write_behind_conf.get("enabled", False):
+            self.WriteBehind = WriteBehindQueue(
+                lambda: psycopg2.connect(**self.ConnectParams),
+                write_behind_conf.get("max_delay_ms", 20)/1000.0,
+                write_behind_conf.get("max_batch", 500),
+                self.OnRecordsWritten)
+        self.FlushTimeout = write_behind_conf.get("flush_timeout", 10.0)
+
+    def Close(self) -> None:
+        if not (self.WriteBehind is None):
+            unwritten = self.WriteBehind.Close()
+            if unwritten > 0:
+                logging.error("Write-behind queue closed with %s unwritten records", unwritten)
+        self.Pool.closeall()
+        if not (self.ReplicaPool is None):
+            self.ReplicaPool.closeall()
+
+    def OnRecordsWritten(self, chat_ids:set[int]) -> None:
+        for chat_id in chat_ids:
+            self.OnChatWritten(chat_id)
+
+    # Called after a commit that changes the chat's records
+    def OnChatWritten(self, chat_id:int) -> None:
+        self.RecentChats.Mark(chat_id)
+        self.ResultCache.InvalidateChat(chat_id)
+
+    # arguments: the bound arguments of a read method
+    def IsPinned(self, arguments:dict) -> bool:
+        return self.RecentWriters.IsPinned(arguments.get("user_id")) or self.RecentChats.IsPinned(arguments.get("chat_id"))
+
+    # Makes the user's buffered records visible to the following read in this chat
+    def FlushPendingFor(self, user_id:int, chat_id:int) -> None:
+        if not (self.WriteBehind is None) and self.WriteBehind.HasPending(user_id, chat_id):
+            self.WriteBehind.Flush(self.FlushTimeout)
+
+    def FlushPendingForUser(self, user_id:int) -> None:
+        if not (self.WriteBehind is None) and self.WriteBehind.HasPendingForUser(user_id):
+            self.WriteBehind.Flush(self.FlushTimeout)
         
+    def EnsureUserExists(self, user_id:int, title:str) -> None:
+        if self.KnownUsers.IsKnown(user_id, title):
+            return
+        self.UpsertUser(user_id, title)
+        self.KnownUsers.Add(user_id, title)
+
+    def EnsureChatExists(self, chat_id:int, title:str) -> None:
+        if self.KnownChats.IsKnown(chat_id, title):
+            return
+        self.UpsertChat(chat_id, title)
+        self.KnownChats.Add(chat_id, title)
+
+    @ConnectionPool
+    def UpsertUser(self, user_id:int, title:str, connection=None) -> None:
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(UPSERT_USER.Bind(connection, self.UsePreparedStatements), {"user_id": user_id, "user_title": title})
+        connection.commit()
+
+    @ConnectionPool
+    def UpsertChat(self, chat_id:int, title:str, connection=None) -> None:
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(UPSERT_CHAT.Bind(connection, self.UsePreparedStatements), {"chat_id": chat_id, "chat_title": title})
+        connection.commit()
+
+    def InsertSelfContribRecord(self, user_id:int, chat_id:int, amount:int) -> None:
+        self.RecentWriters.Mark(user_id)
+        if self.WriteBehind is None:
+            self.WriteSelfContribRecord(user_id, chat_id, amount)
+        else:
+            self.WriteBehind.Add(user_id, chat_id, amount)
+        self.OnChatWritten(chat_id)
+
     @ConnectionPool    
-    def InsertSelfContribRecord(self, user_id:int, chat_id:int, amount:int, connection=None) -> None:
+    def WriteSelfContribRecord(self, user_id:int, chat_id:int, amount:int, connection=None) -> None:
         ps_cursor = connection.cursor() 
-        ps_cursor.execute("INSERT INTO self_contrib_record (user_id, chat_id, amount) VALUES (%s, %s, %s)", (user_id, chat_id, amount)) 
+        ps_cursor.execute(INSERT_RECORD.Bind(connection, self.UsePreparedStatements), {"user_id": user_id, "chat_id": chat_id, "amount": amount}) 
         connection.commit() 
 
+    def PushContribution(self, user_id:int, user_title:str, chat_id:int, chat_title:str, amount:int, day_limit:int, now_ts:datetime) -> PushResult:
+        self.RecentWriters.Mark(user_id)
+        if self.WriteBehind is None:
+            return self.PushContributionTransaction(user_id, user_title, chat_id, chat_title, amount, day_limit, now_ts)
+
+        # Buffered mode: the limit is checked against committed and the user's own flushed rows,
+        # the record itself is committed by the write-behind queue
+        self.EnsureUserExists(user_id, user_title)
+        self.EnsureChatExists(chat_id, chat_title)
+        sums = self.GetAmountSums(user_id, chat_id, {"day": now_ts - timedelta(days=1), "week": now_ts - timedelta(days=7)}, now_ts)
+        if sums["day"] > day_limit:
+            return PushResult(False, sums["day"], sums["week"])
+        self.WriteBehind.Add(user_id, chat_id, amount)
+        self.OnChatWritten(chat_id)
+        return PushResult(True, sums["day"] + amount, sums["week"] + amount)
+
+    # Registration, daily limit check, insert and fresh 1/7-day totals in one transaction and one
+    # round trip. The per-user advisory lock runs as its own statement before the CTE takes its
+    # snapshot, so concurrent pushes of the same user cannot both pass the limit check. The sums have
+    # no upper bound: rows committed while waiting for the lock are stamped with a DB now() later
+    # than the caller's now_ts and must still count
+    @ConnectionPool
+    def PushContributionTransaction(self, user_id:int, user_title:str, chat_id:int, chat_title:str, amount:int, day_limit:int, now_ts:datetime, connection=None) -> PushResult:
+        register_user = not self.KnownUsers.IsKnown(user_id, user_title)
+        register_chat = not self.KnownChats.IsKnown(chat_id, chat_title)
+        params = {
+            "user_id": user_id, "user_title": user_title, "chat_id": chat_id, "chat_title": chat_title,
+            "amount": amount, "day_limit": day_limit,
+            "day_start": now_ts - timedelta(days=1), "week_start": now_ts - timedelta(days=7)}
+
+        ps_cursor = connection.cursor()
+        try:
+            statements = []
+            if register_user:
+                statements.append(UPSERT_USER)
+            if register_chat:
+                statements.append(UPSERT_CHAT)
+            statements += [PUSH_LOCK, PUSH_CONTRIBUTION]
+            query = "; ".join([st.Bind(connection, self.UsePreparedStatements) for st in statements])
+            ps_cursor.execute(query, params)
+            row = ps_cursor.fetchone()
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+        if register_user:
+            self.KnownUsers.Add(user_id, user_title)
+        if register_chat:
+            self.KnownChats.Add(chat_id, chat_title)
+
+        if row[0] < 1:
+            return PushResult(False, row[1], row[2])
+        self.OnChatWritten(chat_id)
+        return PushResult(True, row[1] + amount, row[2] + amount)
+
     @ConnectionPool    
-    def DeleteLastSelfContribRecords(self, user_id:int, chat_id:int, limit:int, connection=None) -> None:
+    def DeleteLastSelfContribRecords(self, user_id:int, chat_id:int, limit:int, remaining_count:int = 5, connection=None) -> PopResult:
+        self.RecentWriters.Mark(user_id)
+        self.FlushPendingFor(user_id, chat_id)
         ps_cursor = connection.cursor() 
+        ps_cursor.execute(POP_LAST.Bind(connection, self.UsePreparedStatements),
+            {"user_id": user_id, "chat_id": chat_id, "limit": limit, "remaining": remaining_count})
+        rows = ps_cursor.fetchall()
+        connection.commit()
 
-        ps_cursor.execute("SELECT ts FROM self_contrib_record WHERE user_id = %s AND chat_id = %s ORDER BY ts DESC LIMIT %s", (user_id, chat_id, limit))        
-        rows = ps_cursor.fetchall()                
-        if len(rows) < 1:
-            return
-        
-        row = rows[-1]
-        ps_cursor.execute("DELETE FROM self_contrib_record WHERE user_id = %s AND chat_id = %s AND ts >= %s", (user_id, chat_id, row[0])) 
-        connection.commit()         
+        deleted = [ChatRelatedUserSelfContrib(row[1], row[2]) for row in rows if row[0]]
+        remaining = [ChatRelatedUserSelfContrib(row[1], row[2]) for row in rows if not row[0]]
+        deleted.sort(key=lambda c: c.TS, reverse=True)
+        remaining.sort(key=lambda c: c.TS, reverse=True)
+        if len(deleted) > 0:
+            self.OnChatWritten(chat_id)
+        return PopResult(deleted, remaining)
 
-    @ConnectionPool    
+    @ReadConnectionPool
     def SelectLastUserSelfContribs(self, user_id:int, chat_id:int, limit:int,  connection=None) -> list[ChatRelatedUserSelfContrib]:
+        self.FlushPendingFor(user_id, chat_id)
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT ts, amount FROM self_contrib_record WHERE user_id = %s AND chat_id = %s ORDER BY ts DESC LIMIT %s", (user_id, chat_id, limit))        
+        ps_cursor.execute(SELECT_LAST.Bind(connection, self.UsePreparedStatements), {"user_id": user_id, "chat_id": chat_id, "limit": limit})
         rows = ps_cursor.fetchall()        
         result = []
         for row in rows:
@@ -89,16 +493,36 @@ class DbWorkerService:
 
 
     
-    @ConnectionPool    
-    def GetAllAmountSum(self, user_id:int, connection=None) -> None:
-        raise NotImplementedError("DbWorkerService.CalcAllUserStat")   
+    # Sum over every chat of the user, one index lookup in user_chat_totals
+    @ReadConnectionPool
+    def GetAllAmountSum(self, user_id:int, connection=None) -> int:
+        self.FlushPendingForUser(user_id)
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(ALL_AMOUNT_SUM.Bind(connection, self.UsePreparedStatements), {"user_id": user_id})
+        rows = ps_cursor.fetchall()
+        if len(rows) == 1:
+            return rows[0][0] or 0
+        elif len(rows) > 1:
+            raise YSDBException("corrupted DB table")
+        return 0
 
-    @ConnectionPool    
+    # Lifetime totals of the user per chat, largest first
+    @ReadConnectionPool
+    def GetUserChatTotals(self, user_id:int, connection=None) -> list[UserChatTotal]:
+        self.FlushPendingForUser(user_id)
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(USER_CHAT_TOTALS.Bind(connection, self.UsePreparedStatements), {"user_id": user_id})
+        result = []
+        for row in ps_cursor.fetchall():
+            result.append(UserChatTotal(row[0], row[1], row[2], row[3], row[4], row[5]))
+        return result
+
+    @ReadConnectionPool
     def GetAmountSum(self, user_id:int, chat_id:int, start_ts:datetime, end_ts:datetime, connection=None) -> int:
+        self.FlushPendingFor(user_id, chat_id)
         ps_cursor = connection.cursor()          
-        ps_cursor.execute(
-            "SELECT sum(amount) FROM self_contrib_record WHERE user_id = %s AND chat_id = %s AND ts >= %s AND ts <= %s", 
-            (user_id, chat_id, start_ts, end_ts))        
+        ps_cursor.execute(AMOUNT_SUM.Bind(connection, self.UsePreparedStatements),
+            {"user_id": user_id, "chat_id": chat_id, "start_ts": start_ts, "end_ts": end_ts})
         rows = ps_cursor.fetchall()    
         if len(rows) == 1:               
             if rows[0][0] is None:
@@ -107,13 +531,40 @@ class DbWorkerService:
         elif len(rows) > 1:
             raise YSDBException("corrupted DB table")
         return 0
-    
-    @ConnectionPool    
+
+    # windows: key -> window start; every window ends at end_ts. All sums come from a single scan.
+    # A None window start means all time and is answered from user_chat_totals
+    @ReadConnectionPool
+    def GetAmountSums(self, user_id:int, chat_id:int, windows:dict[str, datetime|None], end_ts:datetime, connection=None) -> dict[str, int]:
+        if len(windows) < 1:
+            return {}
+        self.FlushPendingFor(user_id, chat_id)
+        keys = [key for key, start_ts in windows.items() if not (start_ts is None)]
+        total_keys = [key for key, start_ts in windows.items() if start_ts is None]
+        params = {"user_id": user_id, "chat_id": chat_id}
+        if len(keys) > 0:
+            params["from_ts"] = min([windows[key] for key in keys])
+            params["end_ts"] = end_ts
+        for i, key in enumerate(keys):
+            params["w"+str(i)] = windows[key]
+
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(AMOUNT_SUMS.Get((len(keys), len(total_keys) > 0)).Bind(connection, self.UsePreparedStatements), params)
+        rows = ps_cursor.fetchall()
+        if len(rows) > 1:
+            raise YSDBException("corrupted DB table")
+        result = {}
+        for i, key in enumerate(keys):
+            result[key] = (rows[0][i] or 0) if len(rows) == 1 else 0
+        for key in total_keys:
+            result[key] = (rows[0][len(keys)] or 0) if len(rows) == 1 else 0
+        return result
+
+    @ReadConnectionPool
     def GetChatAmountSum(self, chat_id:int, start_ts:datetime, end_ts:datetime, connection=None) -> int:
         ps_cursor = connection.cursor()          
-        ps_cursor.execute(
-            "SELECT sum(amount) FROM self_contrib_record WHERE chat_id = %s AND ts >= %s AND ts <= %s", 
-            (chat_id, start_ts, end_ts))        
+        ps_cursor.execute(CHAT_AMOUNT_SUM.Bind(connection, self.UsePreparedStatements),
+            {"chat_id": chat_id, "start_ts": start_ts, "end_ts": end_ts})
         rows = ps_cursor.fetchall()    
         if len(rows) == 1:            
             return rows[0][0] or 0
@@ -121,12 +572,11 @@ class DbWorkerService:
             raise YSDBException("corrupted DB table")
         return 0
     
-    @ConnectionPool    
+    @ReadConnectionPool
     def GetChatActiveUserCount(self, chat_id:int, start_ts:datetime, end_ts:datetime, connection=None) -> int:
         ps_cursor = connection.cursor()          
-        ps_cursor.execute(
-            "SELECT COUNT(DISTINCT user_id) FROM self_contrib_record WHERE chat_id = %s AND ts >= %s AND ts <= %s GROUP BY chat_id", 
-            (chat_id, start_ts, end_ts))        
+        ps_cursor.execute(CHAT_ACTIVE_USER_COUNT.Bind(connection, self.UsePreparedStatements),
+            {"chat_id": chat_id, "start_ts": start_ts, "end_ts": end_ts})
         rows = ps_cursor.fetchall()    
         if len(rows) == 1:            
             return rows[0][0] or 0
@@ -134,14 +584,31 @@ class DbWorkerService:
             raise YSDBException("corrupted DB table")
         return 0    
 
-    @ConnectionPool    
+    # Returns `periods` items, the current period first
+    @ReadConnectionPool
+    def GetChatPeriodStats(self, chat_id:int, now_ts:datetime, day_count:int, periods:int = 2, connection=None) -> list[ChatPeriodStat]:
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(CHAT_PERIOD_STATS.Bind(connection, self.UsePreparedStatements), {"chat_id": chat_id, "now_ts": now_ts, "day_count": day_count, "periods": periods})
+        rows = ps_cursor.fetchall()
+        result = []
+        for i in range(periods):
+            end_ts = now_ts - timedelta(days=day_count*i)
+            result.append(ChatPeriodStat(end_ts - timedelta(days=day_count), end_ts, 0, 0))
+        for row in rows:
+            result[row[0]].Amount = row[1] or 0
+            result[row[0]].WriterCount = row[2] or 0
+        return result
+
+    @ReadConnectionPool
+    def GetActiveChatIds(self, since_ts:datetime, connection=None) -> list[int]:
+        ps_cursor = connection.cursor()
+        ps_cursor.execute(ACTIVE_CHAT_IDS.Bind(connection, self.UsePreparedStatements), {"since_day": since_ts.date()})
+        return [row[0] for row in ps_cursor.fetchall()]
+
+    @ReadConnectionPool
     def GetTop(self, chat_id:int, start_ts:datetime, end_ts:datetime, connection=None) -> list[ChatTopItem]:
         ps_cursor = connection.cursor() 
-        query = "SELECT u.id, u.title, sum(scr.amount) "
-        query+= "FROM self_contrib_record as scr INNER JOIN sd_user as u ON scr.user_id = u.id "
-        query+= "WHERE ts >= %s AND ts <= %s AND chat_id = %s "
-        query+= "GROUP BY u.id ORDER BY sum(scr.amount) DESC LIMIT 30 OFFSET 0"
-        ps_cursor.execute(query, (start_ts, end_ts, chat_id))
+        ps_cursor.execute(CHAT_TOP.Bind(connection, self.UsePreparedStatements), {"chat_id": chat_id, "start_ts": start_ts, "end_ts": end_ts})
         rows = ps_cursor.fetchall() 
         result = []
         for row in rows:
@@ -0,0 +1,67 @@
+import time
+from datetime import datetime
+from db_worker import ChatTopItem
+
+# generation: the chat's ResultCache generation taken before the board was computed;
+# month_start: beginning of the month the board was computed in
+class Leaderboard:
+    def __init__(self, items:list[ChatTopItem], computed_ts:datetime, generation:int, month_start:datetime):
+        self.Items = items
+        self.ComputedTS = computed_ts
+        self.Computed = time.monotonic()
+        self.Generation = generation
+        self.MonthStart = month_start
+
+# /top results for the most requested windows, precomputed for active chats by a periodic job.
+# Boards older than max_age (e.g. when the job is stuck) are not served, nor boards of a chat
+# written to since they were computed (the ResultCache generation changed) or current-month
+# boards (window 0) computed in another month. A write to an active chat schedules a refresh
+# of its boards refresh_delay seconds later, so /top is served live only in between.
+# Only touched from the event loop thread, so no locking
+class LeaderboardStore:
+    def __init__(self, config:dict):
+        self.Interval = config.get("interval", 300)
+        self.Windows = config.get("windows", [0, 30])
+        self.ActiveDays = config.get("active_days", 7)
+        self.MaxAge = config.get("max_age", 3*self.Interval)
+        self.Concurrency = config.get("concurrency", 4)
+        self.RefreshDelay = config.get("refresh_delay", 1.0)
+        # (index, count) in supervisor mode: only chats routed to this worker are refreshed
+        self.Shard:tuple[int, int]|None = None
+        self.Boards:dict[tuple[int, int], Leaderboard] = {}
+        # active chats of the last refresh and chats with a refresh scheduled after a write
+        self.Chats:set[int] = set()
+        self.PendingChats:set[int] = set()
+        self.LastRefreshTS:datetime|None = None
+        self.LastRefreshSeconds = 0.0
+
+    def Get(self, chat_id:int, window:int, generation:int, month_start:datetime) -> Leaderboard|None:
+        board = self.Boards.get((chat_id, window))
+        if board is None or time.monotonic() - board.Computed > self.MaxAge:
+            return None
+        if board.Generation != generation or (window == 0 and board.MonthStart != month_start):
+            del self.Boards[(chat_id, window)]
+            return None
+        return board
+
+    def Put(self, chat_id:int, window:int, board:Leaderboard) -> None:
+        self.Boards[(chat_id, window)] = board
+
+    # Returns True if the caller has to refresh the chat's boards after RefreshDelay
+    def ScheduleRefresh(self, chat_id:int) -> bool:
+        if self.Interval <= 0 or not (chat_id in self.Chats) or chat_id in self.PendingChats:
+            return False
+        self.PendingChats.add(chat_id)
+        return True
+
+    # Drops boards of chats that are no longer active
+    def Retain(self, chat_ids:set[int]) -> None:
+        self.Chats = chat_ids
+        for key in [key for key in self.Boards if not (key[0] in chat_ids)]:
+            del self.Boards[key]
+
+    def GetStatText(self) -> str:
+        result = "boards "+str(len(self.Boards))
+        if not (self.LastRefreshTS is None):
+            result += ", last refresh "+self.LastRefreshTS.strftime("%H:%M:%S")+" ("+str(round(self.LastRefreshSeconds, 2))+"s)"
+        return result
@@ -0,0 +1,154 @@
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ysdb_logging import UpdateFields
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (0, 1, 5, 10, 30, 100, 1000, 10000)
+
+class Histogram:
+    def __init__(self, buckets:tuple):
+        self.Buckets = buckets
+        self.Counts = [0] * len(buckets)
+        self.Count = 0
+        self.Sum = 0.0
+
+    def Observe(self, value:float) -> None:
+        self.Count += 1
+        self.Sum += value
+        for i, bound in enumerate(self.Buckets):
+            if value <= bound:
+                self.Counts[i] += 1
+                return
+
+    # Upper bound of the bucket holding the given quantile, None if it is above the last bucket
+    def Quantile(self, q:float) -> float|None:
+        rank = q*self.Count
+        cumulative = 0
+        for i, bound in enumerate(self.Buckets):
+            cumulative += self.Counts[i]
+            if cumulative >= rank:
+                return bound
+        return None
+
+def FormatLabels(labels:tuple, extra:str = "") -> str:
+    parts = [k+'="'+str(v).replace('"', '\\"')+'"' for k, v in labels]
+    if len(extra) > 0:
+        parts.append(extra)
+    if len(parts) < 1:
+        return ""
+    return "{"+",".join(parts)+"}"
+
+# Process-wide metrics. Histograms are keyed by (name, labels), labels being a tuple of
+# (key, value) pairs. Gauges are callables sampled on export and return {labels: value}
+class MetricsRegistry:
+    def __init__(self):
+        self.Histograms:dict[str, dict[tuple, Histogram]] = {}
+        self.HistogramBuckets:dict[str, tuple] = {}
+        self.Gauges:dict[str, object] = {}
+        self.Lock = threading.Lock()
+
+    def Observe(self, name:str, labels:tuple, value:float, buckets:tuple = SECONDS_BUCKETS) -> None:
+        with self.Lock:
+            series = self.Histograms.get(name)
+            if series is None:
+                series = {}
+                self.Histograms[name] = series
+                self.HistogramBuckets[name] = buckets
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = Histogram(self.HistogramBuckets[name])
+                series[labels] = histogram
+            histogram.Observe(value)
+
+    def RegisterGauge(self, name:str, func) -> None:
+        with self.Lock:
+            self.Gauges[name] = func
+
+    def Render(self) -> str:
+        lines = []
+        with self.Lock:
+            for name, series in sorted(self.Histograms.items()):
+                lines.append("# TYPE "+name+" histogram")
+                for labels, h in sorted(series.items()):
+                    cumulative = 0
+                    for i, bound in enumerate(h.Buckets):
+                        cumulative += h.Counts[i]
+                        lines.append(name+"_bucket"+FormatLabels(labels, 'le="'+str(bound)+'"')+" "+str(cumulative))
+                    lines.append(name+"_bucket"+FormatLabels(labels, 'le="+Inf"')+" "+str(h.Count))
+                    lines.append(name+"_sum"+FormatLabels(labels)+" "+str(h.Sum))
+                    lines.append(name+"_count"+FormatLabels(labels)+" "+str(h.Count))
+            gauges = list(self.Gauges.items())
+        for name, func in sorted(gauges, key=lambda g: g[0]):
+            lines.append("# TYPE "+name+" gauge")
+            for labels, value in sorted(func().items()):
+                lines.append(name+FormatLabels(labels)+" "+str(value))
+        return "\n".join(lines)+"\n"
+
+    # Short human-readable digest for the /status admin section and the periodic dump
+    def GetSummaryText(self, names:list[str]) -> str:
+        lines = []
+        with self.Lock:
+            for name in names:
+                for labels, h in sorted(self.Histograms.get(name, {}).items()):
+                    if h.Count < 1:
+                        continue
+                    p50 = h.Quantile(0.5)
+                    p99 = h.Quantile(0.99)
+                    lines.append(name+FormatLabels(labels)+": n="+str(h.Count)+
+                        " avg="+str(round(h.Sum/h.Count*1000.0, 1))+"ms"+
+                        " p50<="+("inf" if p50 is None else str(p50*1000.0)+"ms")+
+                        " p99<="+("inf" if p99 is None else str(p99*1000.0)+"ms"))
+        return "\n".join(lines)
+
+METRICS = MetricsRegistry()
+
+# Decorator for YSDBot command handlers (async methods taking self, update, context).
+# With DEBUG logging every call is also logged with its latency as a structured field
+def TimedHandler(command:str):
+    def decorator(function_to_decorate):
+        labels = (("command", command), )
+        @functools.wraps(function_to_decorate)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function_to_decorate(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                METRICS.Observe("ysdb_handler_seconds", labels, elapsed)
+                if logging.root.isEnabledFor(logging.DEBUG) and len(args) > 1:
+                    logging.debug("[%s] %s, handled in %.1f ms", command.upper(), UpdateFields(args[1], command), elapsed*1000.0,
+                        extra={"fields": {"latency_ms": round(elapsed*1000.0, 3)}})
+        return wrapper
+    return decorator
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.Render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# config: the "metrics" section of conf.json
+def StartMetricsExport(config:dict) -> None:
+    if config.get("port", 0) > 0:
+        server = ThreadingHTTPServer((config.get("host", "127.0.0.1"), config["port"]), MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, name="ysdb-metrics-http", daemon=True).start()
+
+    dump_interval = config.get("dump_interval", 0)
+    if dump_interval > 0:
+        def dump():
+            while True:
+                time.sleep(dump_interval)
+                logging.warning("[METRICS]\n%s", METRICS.GetSummaryText(["ysdb_handler_seconds", "ysdb_db_pool_wait_seconds", "ysdb_db_query_seconds"]))
+        threading.Thread(target=dump, name="ysdb-metrics-dump", daemon=True).start()
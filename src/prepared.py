@@ -0,0 +1,51 @@
+import re
+import threading
+import psycopg2.extensions
+
+PARAM_PATTERN = re.compile(r"%\((\w+)\)s")
+
+# Connection that remembers which statements were prepared in its session. A connection
+# opened to replace a dead one starts empty, so statements get prepared again on first use
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.Prepared:set[str] = set()
+
+# SQL statement with named %(name)s parameters. Bind() returns the text to pass to
+# cursor.execute() together with the usual params dict: either the plain SQL or, when prepared
+# statements are enabled, "EXECUTE name (...)" after preparing it once on this connection.
+class Statement:
+    def __init__(self, name:str, param_types:dict[str, str], sql:str):
+        self.Name = name
+        self.Sql = sql
+        names = []
+        for param in PARAM_PATTERN.findall(sql):
+            if not (param in names):
+                names.append(param)
+        body = PARAM_PATTERN.sub(lambda m: "$"+str(names.index(m.group(1)) + 1), sql).replace("%%", "%")
+        self.PrepareSql = "PREPARE "+name+" ("+", ".join([param_types[n] for n in names])+") AS "+body
+        self.ExecuteSql = "EXECUTE "+name+" ("+", ".join(["%("+n+")s" for n in names])+")"
+
+    def Bind(self, connection, use_prepared:bool) -> str:
+        if not use_prepared:
+            return self.Sql
+        if not (self.Name in connection.Prepared):
+            ps_cursor = connection.cursor()
+            ps_cursor.execute(self.PrepareSql)
+            connection.Prepared.add(self.Name)
+        return self.ExecuteSql
+
+# Statements whose text depends on an argument (e.g. the number of windows), built once per key
+class StatementFamily:
+    def __init__(self, build):
+        self.Build = build
+        self.Statements:dict = {}
+        self.Lock = threading.Lock()
+
+    def Get(self, key) -> Statement:
+        with self.Lock:
+            statement = self.Statements.get(key)
+            if statement is None:
+                statement = self.Build(key)
+                self.Statements[key] = statement
+            return statement
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    __slots__ = ("Tokens", "Updated")
+
+    def __init__(self, tokens:float, updated:float):
+        self.Tokens = tokens
+        self.Updated = updated
+
+# Token buckets keyed by chat or user id. A bucket idle for Burst/Rate seconds is full again,
+# i.e. no different from a fresh one, so it can be dropped: memory is bounded by the number of
+# ids active within that window and, as a hard cap, by max_size (least recently used first)
+class BucketMap:
+    def __init__(self, rate:float, burst:float, max_size:int):
+        self.Rate = rate
+        self.Burst = burst
+        self.TTL = burst/rate
+        self.MaxSize = max_size
+        self.Buckets:OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def Get(self, key:int, t:float) -> TokenBucket:
+        bucket = self.Buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.Burst, t)
+            self.Buckets[key] = bucket
+        else:
+            bucket.Tokens = min(self.Burst, bucket.Tokens + (t - bucket.Updated)*self.Rate)
+            bucket.Updated = t
+            self.Buckets.move_to_end(key)
+        self.Evict(t)
+        return bucket
+
+    def Evict(self, t:float) -> None:
+        while len(self.Buckets) > self.MaxSize:
+            self.Buckets.popitem(last=False)
+        while len(self.Buckets) > 0:
+            if t - next(iter(self.Buckets.values())).Updated < self.TTL:
+                break
+            self.Buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.Buckets)
+
+# Limits for one command: a global bucket plus per-chat and per-user buckets.
+# A command passes only when all three buckets have a token, and then takes one from each.
+# clock returns monotonic seconds
+class CommandLimits:
+    def __init__(self, config:dict, max_size:int, clock = time.monotonic):
+        self.Clock = clock
+        self.Global = BucketMap(config["global"]["rate"], config["global"]["burst"], 1)
+        self.Chats = BucketMap(config["chat"]["rate"], config["chat"]["burst"], max_size)
+        self.Users = BucketMap(config["user"]["rate"], config["user"]["burst"], max_size)
+
+    # Returns True if the command has to be ignored
+    def Check(self, user_id:int, chat_id:int) -> bool:
+        t = self.Clock()
+        buckets = [self.Global.Get(0, t), self.Chats.Get(chat_id, t), self.Users.Get(user_id, t)]
+        for bucket in buckets:
+            if bucket.Tokens < 1.0:
+                return True
+        for bucket in buckets:
+            bucket.Tokens -= 1.0
+        return False
+
+    def TrackedCount(self) -> int:
+        return len(self.Chats) + len(self.Users)
+
+def MakeLimit(min_interval:float, burst:float = 1.0) -> dict:
+    return {"rate": 1.0/min_interval, "burst": burst}
+
+DEFAULT_LIMITS = {
+    "push": {"global": MakeLimit(0.3), "chat": MakeLimit(0.5), "user": MakeLimit(0.5)},
+    "pop": {"global": MakeLimit(0.4), "chat": MakeLimit(1.0), "user": MakeLimit(1.0)},
+    "mystat": {"global": MakeLimit(0.7), "chat": MakeLimit(1.25), "user": MakeLimit(1.25)},
+    "stat": {"global": MakeLimit(1.0), "chat": MakeLimit(3.0), "user": MakeLimit(3.0)}
+}
+
+# config: the "limits" section of conf.json. Every command/scope missing there keeps its default
+def MakeCommandLimits(config:dict, command:str) -> CommandLimits:
+    command_config = {}
+    for scope, default in DEFAULT_LIMITS[command].items():
+        command_config[scope] = dict(default)
+        command_config[scope].update(config.get(command, {}).get(scope, {}))
+    return CommandLimits(command_config, config.get("max_tracked_ids", 100000))
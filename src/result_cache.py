@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Short-lived cache of per-chat command results (/top, /stat) keyed by (chat_id, command, window).
+# Writes to a chat drop its entries. A result computed while a write was in progress must not be
+# stored, so Begin() returns the chat's generation and Put() ignores values from an older one.
+# Generations are kept in a fixed array of stripes to stay bounded; a collision only skips a Put.
+# clock returns monotonic seconds
+class ResultCache:
+    GENERATION_STRIPES = 1024
+
+    def __init__(self, ttl:float, max_size:int, clock = time.monotonic):
+        self.Clock = clock
+        self.TTL = ttl
+        self.MaxSize = max_size
+        self.Items:OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+        self.ChatKeys:dict[int, set[tuple]] = {}
+        self.Generations = [0] * self.GENERATION_STRIPES
+        self.Hits = 0
+        self.Misses = 0
+        self.Invalidations = 0
+        self.Lock = threading.Lock()
+
+    def Begin(self, chat_id:int) -> int:
+        with self.Lock:
+            return self.Generations[chat_id % self.GENERATION_STRIPES]
+
+    def Get(self, chat_id:int, command:str, window:int):
+        key = (chat_id, command, window)
+        with self.Lock:
+            item = self.Items.get(key)
+            if item is None or item[0] < self.Clock():
+                if not (item is None):
+                    self.Remove(key)
+                self.Misses += 1
+                return None
+            self.Items.move_to_end(key)
+            self.Hits += 1
+            return item[1]
+
+    def Put(self, chat_id:int, command:str, window:int, value, generation:int) -> None:
+        key = (chat_id, command, window)
+        with self.Lock:
+            if self.Generations[chat_id % self.GENERATION_STRIPES] != generation:
+                return
+            self.Items[key] = (self.Clock() + self.TTL, value)
+            self.Items.move_to_end(key)
+            self.ChatKeys.setdefault(chat_id, set()).add(key)
+            while len(self.Items) > self.MaxSize:
+                self.Remove(next(iter(self.Items)))
+
+    def InvalidateChat(self, chat_id:int) -> None:
+        with self.Lock:
+            self.Generations[chat_id % self.GENERATION_STRIPES] += 1
+            keys = self.ChatKeys.pop(chat_id, None)
+            if keys is None:
+                return
+            self.Invalidations += 1
+            for key in keys:
+                del self.Items[key]
+
+    # Must be called with Lock held
+    def Remove(self, key:tuple) -> None:
+        del self.Items[key]
+        keys = self.ChatKeys[key[0]]
+        keys.discard(key)
+        if len(keys) < 1:
+            del self.ChatKeys[key[0]]
+
+    def GetStatText(self) -> str:
+        with self.Lock:
+            total = self.Hits + self.Misses
+            hit_rate = 100.0*self.Hits/total if total > 0 else 0.0
+            return "hits "+str(self.Hits)+", misses "+str(self.Misses)+" ("+str(round(hit_rate, 1))+"% hits)"+\
+                ", entries "+str(len(self.Items))+"/"+str(self.MaxSize)+", invalidations "+str(self.Invalidations)
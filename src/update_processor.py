@@ -0,0 +1,56 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Processes up to max_concurrent_updates updates at once, but updates of the same chat one after
+# another in arrival order, so e.g. /push and a following /pop never overtake each other.
+# The chat lock is taken before a concurrency slot, so updates queued behind a busy chat don't
+# hold slots other chats could use. Updates without a chat are not serialized.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates:int):
+        super().__init__(max_concurrent_updates)
+        self.Semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self.ChatLocks:dict[int, list] = {}
+        self.InFlight = 0
+
+    @staticmethod
+    def GetChatId(update:object) -> int|None:
+        if isinstance(update, Update) and not (update.effective_chat is None):
+            return update.effective_chat.id
+        return None
+
+    # Replaces the base implementation, which takes the semaphore first
+    async def process_update(self, update:object, coroutine) -> None:
+        self.InFlight += 1
+        try:
+            chat_id = ChatOrderedUpdateProcessor.GetChatId(update)
+            if chat_id is None:
+                async with self.Semaphore:
+                    await self.do_process_update(update, coroutine)
+                return
+
+            entry = self.ChatLocks.get(chat_id)
+            if entry is None:
+                entry = [asyncio.Lock(), 0]
+                self.ChatLocks[chat_id] = entry
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    async with self.Semaphore:
+                        await self.do_process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if entry[1] < 1:
+                    del self.ChatLocks[chat_id]
+        finally:
+            self.InFlight -= 1
+
+    async def do_process_update(self, update:object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
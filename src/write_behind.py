@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extras
+from ysdb_exception import YSDBException
+
+# Buffered writer for self_contrib_record. Rows collected within max_delay seconds (or until
+# max_batch rows are pending) are written with one execute_values and one commit on a
+# dedicated connection owned by the flusher thread, so flushing never competes with the pool.
+# on_written(chat_ids) is called after each batch is committed. Rows rejected by the DB (data or
+# integrity errors) are logged and dropped; any other failure (restart, network) keeps them queued
+# and retries with backoff, since the users were already told their records are saved.
+class WriteBehindQueue:
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 10.0
+    CLOSE_RETRIES = 3
+
+    def __init__(self, connect, max_delay:float, max_batch:int, on_written = None):
+        self.Connect = connect
+        self.OnWritten = on_written
+        self.Connection = None
+        self.MaxDelay = max_delay
+        self.MaxBatch = max_batch
+        self.Pending:list[tuple[int, int, datetime, int]] = []
+        # (user_id, chat_id) -> rows queued or being written
+        self.PendingKeys:dict[tuple[int, int], int] = {}
+        self.AddedCount = 0
+        self.FlushedCount = 0
+        self.FlushRequested = False
+        self.Closing = False
+        self.Stopped = False
+        # rows still not written when Close() gave up retrying
+        self.Unwritten:list[tuple[int, int, datetime, int]] = []
+        self.Condition = threading.Condition()
+        self.Thread = threading.Thread(target=self.Run, name="ysdb-write-behind", daemon=True)
+        self.Thread.start()
+
+    def Add(self, user_id:int, chat_id:int, amount:int) -> datetime:
+        ts = datetime.now(timezone.utc)
+        with self.Condition:
+            if self.Closing:
+                raise YSDBException("write-behind queue is closed")
+            self.Pending.append((user_id, chat_id, ts, amount))
+            key = (user_id, chat_id)
+            self.PendingKeys[key] = self.PendingKeys.get(key, 0) + 1
+            self.AddedCount += 1
+            if len(self.Pending) == 1 or len(self.Pending) >= self.MaxBatch:
+                self.Condition.notify_all()
+        return ts
+
+    def HasPending(self, user_id:int, chat_id:int) -> bool:
+        with self.Condition:
+            return (user_id, chat_id) in self.PendingKeys
+
+    def HasPendingForUser(self, user_id:int) -> bool:
+        with self.Condition:
+            for key in self.PendingKeys:
+                if key[0] == user_id:
+                    return True
+            return False
+
+    # Blocks until every row added before the call is written. While the DB is unreachable rows
+    # stay queued, so a timeout (seconds) turns an outage into an error instead of a hang
+    def Flush(self, timeout:float|None = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.Condition:
+            target = self.AddedCount
+            self.FlushRequested = True
+            self.Condition.notify_all()
+            while self.FlushedCount < target and not self.Stopped:
+                if deadline is None:
+                    self.Condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise YSDBException("🕓 База данных не ответила вовремя, попробуйте чуть позже")
+                self.Condition.wait(remaining)
+
+    # Writes what it can and returns the number of rows that could not be written (they are logged)
+    def Close(self) -> int:
+        with self.Condition:
+            self.Closing = True
+            self.Condition.notify_all()
+        self.Thread.join()
+        if not (self.Connection is None):
+            self.CloseConnection()
+        if len(self.Unwritten) > 0:
+            logging.error("[WRITE-BEHIND] %s rows were not written: %s", len(self.Unwritten), self.Unwritten)
+        return len(self.Unwritten)
+
+    def Run(self) -> None:
+        while True:
+            with self.Condition:
+                while len(self.Pending) < 1 and not self.Closing:
+                    self.Condition.wait()
+                if len(self.Pending) < 1:
+                    self.Stopped = True
+                    self.Condition.notify_all()
+                    return
+                deadline = time.monotonic() + self.MaxDelay
+                while len(self.Pending) < self.MaxBatch and not self.FlushRequested and not self.Closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.Condition.wait(remaining)
+                batch = self.Pending[:self.MaxBatch]
+                del self.Pending[:len(batch)]
+                if len(self.Pending) < 1:
+                    self.FlushRequested = False
+
+            rows = batch
+            delay = self.RETRY_DELAY
+            failures = 0
+            while True:
+                rows = self.Write(rows)
+                if len(rows) < 1:
+                    break
+                failures += 1
+                with self.Condition:
+                    if self.Closing and failures > self.CLOSE_RETRIES:
+                        self.Unwritten.extend(rows)
+                        self.Unwritten.extend(self.Pending)
+                        self.Pending = []
+                        self.Stopped = True
+                        self.Condition.notify_all()
+                        return
+                    self.Condition.wait(delay)
+                delay = min(delay*2, self.MAX_RETRY_DELAY)
+
+            if not (self.OnWritten is None):
+                self.OnWritten(set([row[1] for row in batch]))
+
+            with self.Condition:
+                for row in batch:
+                    key = (row[0], row[1])
+                    self.PendingKeys[key] -= 1
+                    if self.PendingKeys[key] < 1:
+                        del self.PendingKeys[key]
+                self.FlushedCount += len(batch)
+                self.Condition.notify_all()
+
+    # Returns the rows that still have to be written (a suffix of `batch`), empty when every row
+    # was written or dropped as invalid
+    def Write(self, batch:list[tuple[int, int, datetime, int]]) -> list[tuple[int, int, datetime, int]]:
+        try:
+            self.WriteRows(batch)
+            return []
+        except (psycopg2.DataError, psycopg2.IntegrityError) as ex:
+            if len(batch) == 1:
+                logging.error("[WRITE-BEHIND] Dropped record %s. EXCEPTION: %s", batch[0], ex)
+                return []
+            logging.error("[WRITE-BEHIND] Batch of %s rows failed, retrying row by row. EXCEPTION: %s", len(batch), ex)
+        except BaseException as ex:
+            logging.warning("[WRITE-BEHIND] Batch of %s rows not written, will retry. EXCEPTION: %s", len(batch), ex)
+            self.CloseConnection()
+            return batch
+
+        for i, row in enumerate(batch):
+            try:
+                self.WriteRows([row])
+            except (psycopg2.DataError, psycopg2.IntegrityError) as ex:
+                logging.error("[WRITE-BEHIND] Dropped record %s. EXCEPTION: %s", row, ex)
+            except BaseException as ex:
+                logging.warning("[WRITE-BEHIND] %s rows not written, will retry. EXCEPTION: %s", len(batch) - i, ex)
+                self.CloseConnection()
+                return batch[i:]
+        return []
+
+    def CloseConnection(self) -> None:
+        try:
+            if not self.Connection.closed:
+                self.Connection.close()
+        except BaseException:
+            pass
+        self.Connection = None
+
+    def WriteRows(self, rows:list[tuple[int, int, datetime, int]]) -> None:
+        if self.Connection is None or self.Connection.closed:
+            self.Connection = self.Connect()
+        try:
+            ps_cursor = self.Connection.cursor()
+            psycopg2.extras.execute_values(ps_cursor,
+                "INSERT INTO self_contrib_record (user_id, chat_id, ts, amount) VALUES %s", rows, page_size=len(rows))
+            self.Connection.commit()
+        except BaseException:
+            if not self.Connection.closed:
+                self.Connection.rollback()
+            raise
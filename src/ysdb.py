@@ -1,14 +1,25 @@
 from telegram import Update, User, Chat
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, TypeHandler
 import argparse
-from db_worker import DbWorkerService
+import asyncio
+import copy
+import multiprocessing
+import os
+import signal
+import threading
+from db_worker import DbWorkerService, ChatPeriodStat, ChatRelatedUserSelfContrib, ChatTopItem
+from async_db_worker import AsyncDbWorkerService
+from rate_limit import MakeCommandLimits, DEFAULT_LIMITS
+from metrics import METRICS, TimedHandler, StartMetricsExport
+from update_processor import ChatOrderedUpdateProcessor
+from leaderboards import Leaderboard, LeaderboardStore
+from ysdb_logging import UpdateFields, SetupLogging
 import logging
 import json
 import time
 from datetime import timedelta, datetime
 from ysdb_exception import YSDBException
 from zoneinfo import ZoneInfo
-import traceback
     
 def MakeHumanReadableAmount(value:int) -> str:     
     if value > 1000000:
@@ -18,46 +29,26 @@ def MakeHumanReadableAmount(value:int) -> str:
         
     return str(value)
 
-class CommandLimits:
-    def __init__(self, global_min_inteval:float, chat_min_inteval:float):
-        self.GlobalMinimumInterval = global_min_inteval
-        self.ChatMinimumInterval = chat_min_inteval
-        self.ChatLimits:dict[int, float] = {}
-        self.LastHandled = time.time()
-
-    def Check(self, user_id:int, chat_id:int) -> bool:
-        t = time.time() 
-        if t - self.LastHandled < self.GlobalMinimumInterval:            
-            return True
-        if chat_id in self.ChatLimits:
-            if t - self.ChatLimits[chat_id] < self.ChatMinimumInterval: 
-                return True
-            self.ChatLimits[chat_id] = t
-        else:
-            self.ChatLimits[chat_id] = t    
-        
-        self.LastHandledStatCommand = t
-        return False        
-
 class YSDBot:
-    def __init__(self, db_worker:DbWorkerService):
+    def __init__(self, db_worker:AsyncDbWorkerService, limits_config:dict, admin_ids:list[int], leaderboards_config:dict = {}):
         self.Db = db_worker
+        self.Leaderboards = LeaderboardStore(leaderboards_config)
+        # scheduled per-chat leaderboard refreshes; the loop keeps only weak references to tasks
+        self.LeaderboardTasks:set[asyncio.Task] = set()
+        self.AdminIds = set(admin_ids)
         self.StartTS = int(time.time())
         
-        self.PushLimits = CommandLimits(0.3, 0.5)
-        self.PopLimits = CommandLimits(0.4, 1.0)
-        self.MyStatLimits = CommandLimits(0.7, 1.25)
-        self.StatLimits = CommandLimits(1, 3)      
+        self.PushLimits = MakeCommandLimits(limits_config, "push")
+        self.PopLimits = MakeCommandLimits(limits_config, "pop")
+        self.MyStatLimits = MakeCommandLimits(limits_config, "mystat")
+        self.StatLimits = MakeCommandLimits(limits_config, "stat")
+        self.StatPeriodCount = 2
         
 
     @staticmethod
     def GetUserTitleForLog(user:User) -> str:
         return "["+str(user.id)+"]{"+user.name+"}" 
     
-    @staticmethod
-    def GetChatTitleForLog(ch:Chat) -> str:
-        return "["+str(ch.id)+"]{"+ch.effective_name+"}"     
-
     @staticmethod    
     def MakeUserTitle(user:User) -> str:
         result = user.full_name
@@ -140,41 +131,61 @@ class YSDBot:
     def DatetimeToStr(dt:datetime) -> str:
         return  dt.strftime("%d.%m.%Y %H:%M") 
 
-    def MakeLastPushingInfo(self, user_id:int, chat_id:int, count:int) -> str:
-        user_contribs = self.Db.SelectLastUserSelfContribs(user_id, chat_id, count)
+    async def MakeLastPushingInfo(self, user_id:int, chat_id:int, count:int) -> str:
+        return YSDBot.FormatLastPushingInfo(await self.Db.SelectLastUserSelfContribs(user_id, chat_id, count))
+
+    @staticmethod
+    def FormatLastPushingInfo(user_contribs:list[ChatRelatedUserSelfContrib]) -> str:
         result = ""
         cc = 1
         for uc in user_contribs:
             if cc > 1:
                 result += "\n"
 
-            result += "№"+str(cc) +" " + self.DatetimeToStr(uc.TS)+" 📓 "+MakeHumanReadableAmount(uc.Amount)
+            result += "№"+str(cc) +" " + YSDBot.DatetimeToStr(uc.TS)+" 📓 "+MakeHumanReadableAmount(uc.Amount)
             cc += 1
 
         return result
     
-    def MakeShortStatBlock(self, user_id:int, chat_id:int) -> str:
-        result = "Количество за сутки: " + MakeHumanReadableAmount(self.Db.GetAmountSum(user_id, chat_id, datetime.now() - timedelta(days=1), datetime.now()))
-        result += "\nКоличество за неделю: " + MakeHumanReadableAmount(self.Db.GetAmountSum(user_id, chat_id, datetime.now() - timedelta(days=7), datetime.now()))
+    @staticmethod
+    def MakeShortStatBlock(day_amount:int, week_amount:int) -> str:
+        result = "Количество за сутки: " + MakeHumanReadableAmount(day_amount)
+        result += "\nКоличество за неделю: " + MakeHumanReadableAmount(week_amount)
         return result
 
-    def MakeLastPushingInfoBlock(self, user_id:int, chat_id:int, count:int) -> str:
+    async def MakeLastPushingInfoBlock(self, user_id:int, chat_id:int, count:int) -> str:
         result = "📑 Последние записи:\n"
 
-        result += self.MakeLastPushingInfo(user_id, chat_id, count)
+        result += await self.MakeLastPushingInfo(user_id, chat_id, count)
 
         return result
     
-    def MakeTopBlock(self, chat_id:int, day_count:int) -> str:
+    async def MakeTopBlock(self, chat_id:int, day_count:int) -> str:
+        board = self.Leaderboards.Get(chat_id, day_count, self.Db.ResultCache.Begin(chat_id),
+            YSDBot.GetTopIntervalBegin(0, datetime.now()))
+        if not (board is None):
+            return YSDBot.FormatTop(day_count, board.Items) + "\n\n🕓 Обновлено: " + YSDBot.DatetimeToStr(board.ComputedTS)
+
+        result = self.Db.ResultCache.Get(chat_id, "top", day_count)
+        if result is None:
+            generation = self.Db.ResultCache.Begin(chat_id)
+            result = await self.MakeTopBlockUncached(chat_id, day_count)
+            self.Db.ResultCache.Put(chat_id, "top", day_count, result, generation)
+        return result
+
+    @staticmethod
+    def GetTopIntervalBegin(day_count:int, now_ts:datetime) -> datetime:
+        if day_count == 0:
+            return now_ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return now_ts - timedelta(days=day_count)
+
+    @staticmethod
+    def FormatTop(day_count:int, top:list[ChatTopItem]) -> str:
         if day_count == 0:
-            interval_begin = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             result = f"🏆 TОП за текущий месяц\n"
         else:    
             result = f"🏆 TОП за последние {day_count} дней:\n"
-            interval_begin = datetime.now() - timedelta(days=day_count)
 
-        top = self.Db.GetTop(chat_id, interval_begin, datetime.now())
-        
         cc = 1
         for item in top:
             if cc > 1:
@@ -185,6 +196,61 @@ class YSDBot:
 
         return result        
 
+    async def MakeTopBlockUncached(self, chat_id:int, day_count:int) -> str:
+        now_ts = datetime.now()
+        top = await self.Db.GetTop(chat_id, YSDBot.GetTopIntervalBegin(day_count, now_ts), now_ts)
+        return YSDBot.FormatTop(day_count, top)
+
+    # JobQueue callback: recomputes the common /top windows of every chat written to in the last
+    # ActiveDays days, at most Concurrency chats at a time
+    async def RefreshLeaderboards(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        start = time.perf_counter()
+        now_ts = datetime.now()
+        try:
+            chat_ids = await self.Db.GetActiveChatIds(now_ts - timedelta(days=self.Leaderboards.ActiveDays))
+            if not (self.Leaderboards.Shard is None):
+                index, count = self.Leaderboards.Shard
+                chat_ids = [chat_id for chat_id in chat_ids if chat_id % count == index]
+        except BaseException as ex:
+            logging.error("[LEADERBOARDS] Failed to list active chats. EXCEPTION: %s", ex)
+            return
+
+        semaphore = asyncio.Semaphore(self.Leaderboards.Concurrency)
+        async def refresh(chat_id:int) -> None:
+            async with semaphore:
+                await self.RefreshChatLeaderboards(chat_id)
+
+        await asyncio.gather(*[refresh(chat_id) for chat_id in chat_ids])
+        self.Leaderboards.Retain(set(chat_ids))
+        self.Leaderboards.LastRefreshTS = now_ts
+        self.Leaderboards.LastRefreshSeconds = time.perf_counter() - start
+        METRICS.Observe("ysdb_leaderboard_refresh_seconds", (), self.Leaderboards.LastRefreshSeconds)
+
+    async def RefreshChatLeaderboards(self, chat_id:int) -> None:
+        for window in self.Leaderboards.Windows:
+            computed_ts = datetime.now()
+            generation = self.Db.ResultCache.Begin(chat_id)
+            try:
+                top = await self.Db.GetTop(chat_id, YSDBot.GetTopIntervalBegin(window, computed_ts), computed_ts)
+            except BaseException as ex:
+                logging.error("[LEADERBOARDS] chat id %s, window %s. EXCEPTION: %s", chat_id, window, ex)
+                continue
+            self.Leaderboards.Put(chat_id, window,
+                Leaderboard(top, computed_ts, generation, YSDBot.GetTopIntervalBegin(0, computed_ts)))
+
+    # Called after a write to the chat: its boards are no longer served, recompute them shortly
+    # (writes within the delay share one refresh, and buffered records get flushed by then)
+    def OnChatWritten(self, chat_id:int) -> None:
+        if self.Leaderboards.ScheduleRefresh(chat_id):
+            task = asyncio.get_running_loop().create_task(self.RefreshChatLeaderboardsLater(chat_id))
+            self.LeaderboardTasks.add(task)
+            task.add_done_callback(self.LeaderboardTasks.discard)
+
+    async def RefreshChatLeaderboardsLater(self, chat_id:int) -> None:
+        await asyncio.sleep(self.Leaderboards.RefreshDelay)
+        self.Leaderboards.PendingChats.discard(chat_id)
+        await self.RefreshChatLeaderboards(chat_id)
+
     @staticmethod
     def MakeErrorMessage(ex: YSDBException) -> str:
         return "⛔️ Ошибка!\n\n"+str(ex)
@@ -193,109 +259,135 @@ class YSDBot:
     def MakeExternalErrorMessage(ex: BaseException) -> str:
         return "❗️ Ошибка при выполнении команды: "+str(ex)
 
+    @TimedHandler("push")
     async def push(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        logging.info("[PUSH] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat) + ", text: "+update.message.text)    
+        logging.info("[PUSH] %s", UpdateFields(update, "push"))
         if self.PushLimits.Check(update.effective_user.id, update.effective_chat.id):
-            logging.warning("[PUSH] Ignore command from user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat) + ", text: "+update.message.text)
+            logging.warning("[PUSH] Ignore command from %s", UpdateFields(update, "push"))
             return
-        self.LastHandledPushCommand = time.time()
 
         try:
-            self.Db.EnsureUserExists(update.effective_user.id, YSDBot.MakeUserTitle(update.effective_user))
-            self.Db.EnsureChatExists(update.effective_chat.id, YSDBot.MakeChatTitle(update.effective_chat))            
-        
             amount = YSDBot.ParsePushMessage(update.message.text)            
 
             if amount < 1:
                 raise YSDBException("🚫 Меньше одного символа пушить нельзя") 
             if amount > 80000:
                 raise YSDBException("🚫 Больше 80k пушить нельзя")
-            current_day_counter = self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=1), datetime.now())     
-            if current_day_counter > 100000:
+
+            result = await self.Db.PushContribution(
+                update.effective_user.id, YSDBot.MakeUserTitle(update.effective_user),
+                update.effective_chat.id, YSDBot.MakeChatTitle(update.effective_chat),
+                amount, 100000, datetime.now())
+            if not result.Accepted:
                 raise YSDBException("🥴 Мне кажется, что ты за сегодня уже много написал. Тебе надо бы отдохнуть")
-            
-            self.Db.InsertSelfContribRecord(update.effective_user.id, update.effective_chat.id, amount)
+            self.OnChatWritten(update.effective_chat.id)
 
             reply_message = "✅ Сохранено "+MakeHumanReadableAmount(amount)+" символов."
-            reply_message += "\n\n"+self.MakeShortStatBlock(update.effective_user.id, update.effective_chat.id)
+            reply_message += "\n\n"+YSDBot.MakeShortStatBlock(result.DayAmount, result.WeekAmount)
             #reply_message += "\n\n"+self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 3)
 
             await update.message.reply_text(reply_message) 
         except YSDBException as ex:
             await update.message.reply_text(YSDBot.MakeErrorMessage(ex)) 
         except BaseException as ex:    
-            logging.error("[PUSH] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat) + ", text: "+update.message.text + ". EXCEPTION: "+str(ex))       
+            logging.error("[PUSH] %s. EXCEPTION: %s", UpdateFields(update, "push"), ex)
             await update.message.reply_text(YSDBot.MakeExternalErrorMessage(ex))
     
 
+    @TimedHandler("pop")
     async def pop(self,update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        logging.info("[POP] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat)+ ", text: "+update.message.text)    
+        logging.info("[POP] %s", UpdateFields(update, "pop"))
         if self.PopLimits.Check(update.effective_user.id, update.effective_chat.id):
-            logging.warning("[POP] Ignore command from user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat)+ ", text: "+update.message.text)
+            logging.warning("[POP] Ignore command from %s", UpdateFields(update, "pop"))
             return
-        self.LastHandledPopCommand = time.time()
 
         if not update.message.text.strip().lower().endswith("yes"):
             reply_message = "⚠️ Чтобы выполнить операцию, введите команду вручную:\n\n/pop yes"
-            reply_message += "\n\n"+self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 5)
+            reply_message += "\n\n"+await self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 5)
             await update.message.reply_text(reply_message) 
 
             return
 
         try:
-            self.Db.DeleteLastSelfContribRecords(update.effective_user.id, update.effective_chat.id, 1)
-            reply_message = "☑️ Выполнена попытка удаления последней записи.\n\n"+self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 5)
+            pop_result = await self.Db.DeleteLastSelfContribRecords(update.effective_user.id, update.effective_chat.id, 1, 5)
+            if len(pop_result.Deleted) > 0:
+                self.OnChatWritten(update.effective_chat.id)
+                deleted = pop_result.Deleted[0]
+                reply_message = "☑️ Удалена запись от "+YSDBot.DatetimeToStr(deleted.TS)+" 📓 "+MakeHumanReadableAmount(deleted.Amount)
+            else:
+                reply_message = "☑️ Нет записей для удаления"
+            reply_message += "\n\n📑 Последние записи:\n"+YSDBot.FormatLastPushingInfo(pop_result.Remaining)
             await update.message.reply_text(reply_message) 
         except YSDBException as ex:
             await update.message.reply_text(YSDBot.MakeErrorMessage(ex)) 
         except BaseException as ex:    
-            logging.error("[POP] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat) + ", text: "+update.message.text + ". EXCEPTION: "+str(ex))       
+            logging.error("[POP] %s. EXCEPTION: %s", UpdateFields(update, "pop"), ex)
             await update.message.reply_text(YSDBot.MakeExternalErrorMessage(ex))
            
 
+    @TimedHandler("mystat")
     async def mystat(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        logging.info("[MYSTAT] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))    
+        logging.info("[MYSTAT] %s", UpdateFields(update, "mystat"))
         if self.MyStatLimits.Check(update.effective_user.id, update.effective_chat.id):
-            logging.warning("[MYSTAT] Ignore command from user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))        
+            logging.warning("[MYSTAT] Ignore command from %s", UpdateFields(update, "mystat"))
             return
-        self.LastHandledMyStatCommand = time.time()
 
         t = YSDBot.ParseMyStatType(update.message.text)
         full = (t == "full")
 
 
         stat_message = "Привет, " + YSDBot.MakeUserTitle(update.effective_user) + "!\n\n"
-        stat_message += self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 10 if full else 5)
+        stat_message += await self.MakeLastPushingInfoBlock(update.effective_user.id, update.effective_chat.id, 10 if full else 5)
 
         stat_message += "\n\n📊 Данные по знакам"
         now_ts =  datetime.now()
-        stat_message += "\nЗа последние сутки: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=1), now_ts))
-        #stat_message += "\nЗа последние 3 суток: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=3), now_ts))
-        stat_message += "\nЗа последние 7 суток: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=7), now_ts))
-        if full:
-            stat_message += "\nЗа последние 15 суток: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=15), now_ts))
-        stat_message += "\nЗа последние 30 суток: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=30), now_ts))
         month_first_day = now_ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        stat_message += "\nЗа текущий месяц: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, month_first_day, datetime.now()))
+        windows = {
+            "1": now_ts - timedelta(days=1),
+            "7": now_ts - timedelta(days=7),
+            "30": now_ts - timedelta(days=30),
+            "month": month_first_day}
         if full:
-            stat_message += "\nЗа всё время: "+MakeHumanReadableAmount(self.Db.GetAmountSum(update.effective_user.id, update.effective_chat.id, datetime.now() - timedelta(days=3600), now_ts))
+            windows["15"] = now_ts - timedelta(days=15)
+            windows["all"] = None
+        sums = await self.Db.GetAmountSums(update.effective_user.id, update.effective_chat.id, windows, now_ts)
+
+        stat_message += "\nЗа последние сутки: "+MakeHumanReadableAmount(sums["1"])
+        stat_message += "\nЗа последние 7 суток: "+MakeHumanReadableAmount(sums["7"])
+        if full:
+            stat_message += "\nЗа последние 15 суток: "+MakeHumanReadableAmount(sums["15"])
+        stat_message += "\nЗа последние 30 суток: "+MakeHumanReadableAmount(sums["30"])
+        stat_message += "\nЗа текущий месяц: "+MakeHumanReadableAmount(sums["month"])
+        if full:
+            stat_message += "\nЗа всё время: "+MakeHumanReadableAmount(sums["all"])
 
         if update.effective_user.id == update.effective_chat.id:
-            stat_message += "\n\n((Тут будет статистика по всем чатам))"
+            stat_message += await self.MakeAllChatsBlock(update.effective_user.id)
 
         await update.message.reply_text(stat_message)     
 
 
 
-    def GetStatTextByInterval(self, pstart:datetime, pend:datetime, chat_id:int) -> str:
-        result = "Период: c "+self.DatetimeToStr(pstart) + " по " +self.DatetimeToStr(pend)
+    # Lifetime totals of the user in every chat, shown in the private chat with the bot
+    async def MakeAllChatsBlock(self, user_id:int) -> str:
+        totals = await self.Db.GetUserChatTotals(user_id)
+        if len(totals) < 1:
+            return ""
+        result = "\n\n🌍 По всем чатам: "+MakeHumanReadableAmount(sum([t.Total for t in totals]))
+        for t in totals:
+            result += "\n▫️ "+t.Title+": "+MakeHumanReadableAmount(t.Total)+" (с "+YSDBot.DatetimeToStr(t.FirstTS)+")"
+        return result
+
+    @staticmethod
+    def GetStatTextByPeriod(period:ChatPeriodStat) -> str:
+        result = "Период: c "+YSDBot.DatetimeToStr(period.StartTS) + " по " +YSDBot.DatetimeToStr(period.EndTS)
 
-        day_count = (pend - pstart).days
-        total_amount = self.Db.GetChatAmountSum(chat_id, pstart, pend)
+        day_count = (period.EndTS - period.StartTS).days
+        total_amount = period.Amount
         result += "\nКоличество знаков по всем пользователям: "+MakeHumanReadableAmount(total_amount)        
         day_amount_avg = total_amount/day_count
         result += "\nВ среднем за сутки: " + MakeHumanReadableAmount(day_amount_avg)
-        writer_count = self.Db.GetChatActiveUserCount(chat_id, pstart, pend)        
+        writer_count = period.WriterCount
         result += f"\nПишуших участников: {writer_count}"
         if writer_count > 0:
             result += "\nВ среднем по участнику за период: " + MakeHumanReadableAmount(total_amount/writer_count)
@@ -304,38 +396,51 @@ class YSDBot:
         return result
     
 
+    async def MakeStatBlock(self, chat_id:int, day_count:int) -> str:
+        result = self.Db.ResultCache.Get(chat_id, "stat", day_count)
+        if not (result is None):
+            return result
+
+        generation = self.Db.ResultCache.Begin(chat_id)
+        periods = await self.Db.GetChatPeriodStats(chat_id, datetime.now(), day_count, self.StatPeriodCount)
+        result = YSDBot.GetStatTextByPeriod(periods[0])
+        for i in range(1, len(periods)):
+            if i == 1:
+                result += f"\n\nПредыдущий период {day_count} дней\n"
+            else:
+                result += f"\n\nПериод {day_count} дней, {i}-й назад\n"
+            result += YSDBot.GetStatTextByPeriod(periods[i])
+
+        self.Db.ResultCache.Put(chat_id, "stat", day_count, result, generation)
+        return result
+
+    @TimedHandler("stat")
     async def stat(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:        
-        logging.info("[STAT] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))    
+        logging.info("[STAT] %s", UpdateFields(update, "stat"))
         if self.StatLimits.Check(update.effective_user.id, update.effective_chat.id):
-            logging.warning("[STAT] Ignore command from user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))                
+            logging.warning("[STAT] Ignore command from %s", UpdateFields(update, "stat"))
             return
 
 
         day_count = self.ParseStatParamsAndValidate(update.message.text)            
         stat_message = f"📊 Статистика за {day_count} дней (чат " + YSDBot.MakeChatTitle(update.effective_chat) + ")\n\n"
-        current_period_start = datetime.now() - timedelta(days=day_count)
-        stat_message += self.GetStatTextByInterval(current_period_start, datetime.now(), update.effective_chat.id)
-
-        stat_message += f"\n\nПредыдущий период {day_count} дней\n"
-        current_period_end = current_period_start
-        current_period_start = current_period_end - timedelta(days=day_count)
-        stat_message += self.GetStatTextByInterval(current_period_start, current_period_end, update.effective_chat.id)
+        stat_message += await self.MakeStatBlock(update.effective_chat.id, day_count)
 
         stat_message += "\n\nℹ️ Чтобы получить топ по юзерам, введите команду /top (или /top <кол-во дней>, например, /top 25)"
 
         await update.message.reply_text(stat_message)     
 
 
+    @TimedHandler("top")
     async def top(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:        
-        logging.info("[TOP] user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))    
+        logging.info("[TOP] %s", UpdateFields(update, "top"))
         if self.StatLimits.Check(update.effective_user.id, update.effective_chat.id):
-            logging.warning("[TOP] Ignore command from user id "+YSDBot.GetUserTitleForLog(update.effective_user)+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))                
+            logging.warning("[TOP] Ignore command from %s", UpdateFields(update, "top"))
             return
-        self.LastHandledStatCommand = time.time()
 
         
         day_count = YSDBot.ParseTopParamsAndValidate(update.message.text)
-        stat_message = self.MakeTopBlock(update.effective_chat.id, day_count)
+        stat_message = await self.MakeTopBlock(update.effective_chat.id, day_count)
         #stat_message+= "\n\nДанные по чату: " + YSDBot.MakeChatTitle(update.effective_chat)         
 
         await update.message.reply_text(stat_message)        
@@ -360,34 +465,45 @@ class YSDBot:
 
         return result
 
+    def MakeAdminStatusBlock(self) -> str:
+        result = "🛠 Метрики"
+        result += "\nКэш /top и /stat: "+ self.Db.ResultCache.GetStatText()
+        result += "\nПул соединений: "+ self.Db.Db.Pool.GetStatText()
+        if not (self.Db.Db.ReplicaPool is None):
+            result += "\nПул реплики: "+ self.Db.Db.ReplicaPool.GetStatText()
+        result += "\nПредрасчитанные /top: "+ self.Leaderboards.GetStatText()
+        result += "\n"+ METRICS.GetSummaryText(["ysdb_handler_seconds", "ysdb_db_pool_wait_seconds", "ysdb_db_query_seconds"])
+        return result
+
+    @TimedHandler("status")
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         ut = YSDBot.GetUserTitleForLog(update.effective_user)
-        logging.info("[STATUS] user id "+ut+", chat id "+YSDBot.GetChatTitleForLog(update.effective_chat))    
+        logging.info("[STATUS] %s", UpdateFields(update, "status"))    
         status_msg = "Привет, "+YSDBot.MakeUserTitle(update.effective_user)+"! ("+ut+")"
         status_msg +="\nЭто чат: "+YSDBot.MakeChatTitle(update.effective_chat)
         uptime_sec = time.time() - self.StartTS
         uptime = timedelta(seconds = uptime_sec)
         status_msg +="\nАптайм "+ str(uptime)
         status_msg += "\n\n"+ YSDBot.get_help()
+        if update.effective_user.id in self.AdminIds:
+            status_msg += "\n\n"+ self.MakeAdminStatusBlock()
 
         #status_msg +="\nВерсия "+ str(uptime)
         await update.message.reply_text(status_msg)
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if update is None:
-            logging.warning("Exception: "+ str(context.error))
+            logging.warning("Exception: %s", context.error)
         else:    
-            logging.info("Exception: user id "+self.GetUserTitleForLog(update.effective_user)+", chat id "+self.GetChatTitleForLog(update.effective_chat), exc_info=context.error)
+            logging.info("Exception: %s", UpdateFields(update, None), exc_info=context.error)
 
         message_text = "impossible case (lol)"
         if isinstance(context.error, YSDBException): 
-            logging.warning("YSDBException: "+str(context.error))          
+            logging.warning("YSDBException: %s", context.error)
             message_text = self.MakeErrorMessage(context.error)           
         else:
-            logging.error("EXCEPTION: "+str(context.error))
-            tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-            tb_string = "".join(tb_list)
-            logging.warning("Exception traceback:" + tb_string)            
+            logging.error("EXCEPTION: %s", context.error)
+            logging.warning("Exception traceback:", exc_info=context.error)
             message_text = self.MakeExternalErrorMessage(context.error)
         
         if update is None:
@@ -396,14 +512,183 @@ class YSDBot:
             await update.message.reply_text(message_text)        
 
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.WARNING, format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+def BuildApplication(conf:dict, bot:YSDBot, builder = None):
+    concurrency = conf.get('updates', {}).get('concurrency', 1)
+    if builder is None:
+        builder = ApplicationBuilder()
+    builder = builder.token(conf['bot_token'])
+    if concurrency > 1:
+        processor = ChatOrderedUpdateProcessor(concurrency)
+        METRICS.RegisterGauge("ysdb_updates_in_flight", lambda: {(): processor.InFlight})
+        builder = builder.concurrent_updates(processor)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("status", bot.status))
+    app.add_handler(CommandHandler("push", bot.push))
+    app.add_handler(CommandHandler("pop", bot.pop))
+    app.add_handler(CommandHandler("mystat", bot.mystat))
+    app.add_handler(CommandHandler("stat", bot.stat))
+    app.add_handler(CommandHandler("top", bot.top))
+    app.add_error_handler(bot.error_handler)
+
+    if bot.Leaderboards.Interval > 0:
+        if app.job_queue is None:
+            logging.warning("JobQueue is not available (python-telegram-bot[job-queue] is not installed), leaderboards are computed on demand")
+        else:
+            app.job_queue.run_repeating(bot.RefreshLeaderboards, interval=bot.Leaderboards.Interval, first=1, name="leaderboards")
+    return app
+
+# config: the "webhook" section of conf.json. Telegram must be able to reach webhook_url,
+# usually through a reverse proxy in front of listen:port
+def RunWebhook(app, config:dict) -> None:
+    url_path = config.get('url_path', 'ysdb')
+    app.run_webhook(
+        listen=config.get('listen', '127.0.0.1'),
+        port=config.get('port', 8443),
+        url_path=url_path,
+        webhook_url=config.get('webhook_url'),
+        secret_token=config.get('secret_token'),
+        cert=config.get('cert'),
+        key=config.get('key'),
+        max_connections=config.get('max_connections', 40),
+        drop_pending_updates=config.get('drop_pending_updates', False))
+
+def MakeDbServices(db_conf:dict) -> tuple[DbWorkerService, AsyncDbWorkerService]:
+    db = DbWorkerService(db_conf)
+    return db, AsyncDbWorkerService(db, min(db_conf.get('workers', db.MaxConnections), db.MaxConnections))
+
+def Run(conf:dict, mode:str) -> None:
+    db, async_db = MakeDbServices(conf['db'])
+    try:
+        bot = YSDBot(async_db, conf.get('limits', {}), conf.get('admins', []), conf.get('leaderboards', {}))
+        StartMetricsExport(conf.get('metrics', {}))
+        app = BuildApplication(conf, bot)
+        if mode == 'webhook':
+            RunWebhook(app, conf.get('webhook', {}))
+        else:
+            app.run_polling()
+    finally:
+        async_db.Close()
+        db.Close()
+
+def ShardOf(chat_id:int|None, count:int) -> int:
+    if chat_id is None:
+        return 0
+    return chat_id % count
+
+# Share of one of `count` worker processes: pool, executor and global rate limits are divided
+# between the workers, metrics ports follow the supervisor's one
+def MakeWorkerConf(conf:dict, index:int, count:int) -> dict:
+    worker_conf = copy.deepcopy(conf)
+    db_conf = worker_conf['db']
+    pool_confs = [db_conf.setdefault('pool', {})]
+    if 'replica' in db_conf:
+        pool_confs.append(db_conf['replica'].setdefault('pool', dict(db_conf['pool'])))
+    for pool_conf in pool_confs:
+        pool_conf['max'] = max(1, pool_conf.get('max', 20) // count)
+        pool_conf['min'] = min(pool_conf['max'], max(1, pool_conf.get('min', 5) // count))
+    if 'workers' in db_conf:
+        db_conf['workers'] = max(1, db_conf['workers'] // count)
+
+    limits = worker_conf.setdefault('limits', {})
+    for command, scopes in DEFAULT_LIMITS.items():
+        limit = dict(scopes['global'])
+        limit.update(limits.get(command, {}).get('global', {}))
+        limit['rate'] = limit['rate'] / count
+        limits.setdefault(command, {})['global'] = limit
+
+    metrics_conf = worker_conf.setdefault('metrics', {})
+    if metrics_conf.get('port', 0) > 0:
+        metrics_conf['port'] += index + 1
+    return worker_conf
+
+# Worker process: an Application without updater fed with the updates of its chats
+async def ServeWorker(conf:dict, index:int, count:int, updates) -> None:
+    db, async_db = MakeDbServices(conf['db'])
+    try:
+        bot = YSDBot(async_db, conf.get('limits', {}), conf.get('admins', []), conf.get('leaderboards', {}))
+        bot.Leaderboards.Shard = (index, count)
+        StartMetricsExport(conf.get('metrics', {}))
+        app = BuildApplication(conf, bot, ApplicationBuilder().updater(None))
+        loop = asyncio.get_running_loop()
+        async with app:
+            await app.start()
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+            await app.stop()
+    finally:
+        async_db.Close()
+        db.Close()
+
+def RunWorker(conf:dict, index:int, count:int, updates) -> None:
+    # Ctrl+C reaches the whole process group; workers stop when the supervisor tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = SetupLogging(conf.get('logging', {}))
+    try:
+        asyncio.run(ServeWorker(MakeWorkerConf(conf, index, count), index, count, updates))
+    finally:
+        log_listener.stop()
+
+# Receives updates (polling or webhook, "supervisor.ingest") and routes each one to worker
+# chat_id % N through that worker's queue. All updates of a chat go to the same worker, so
+# per-chat ordering and rate limits hold. Dead workers are restarted and continue from their queue
+def RunSupervisor(conf:dict) -> None:
+    supervisor_conf = conf.get('supervisor', {})
+    count = supervisor_conf.get('workers', os.cpu_count() or 1)
+    mp_context = multiprocessing.get_context('spawn')
+    queues = [mp_context.Queue() for i in range(count)]
+    processes = [None] * count
+    stopping = threading.Event()
+
+    def start(index:int) -> None:
+        process = mp_context.Process(target=RunWorker, args=(conf, index, count, queues[index]), name="ysdb-worker-"+str(index))
+        process.start()
+        processes[index] = process
+
+    def watch() -> None:
+        while not stopping.wait(1.0):
+            for index, process in enumerate(processes):
+                if not process.is_alive() and not stopping.is_set():
+                    logging.error("[SUPERVISOR] Worker %s exited with code %s, restarting", index, process.exitcode)
+                    start(index)
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        queues[ShardOf(None if chat is None else chat.id, count)].put(update.to_json())
+
+    for index in range(count):
+        start(index)
+    watcher = threading.Thread(target=watch, name="ysdb-supervisor-watch", daemon=True)
+    watcher.start()
+
+    app = ApplicationBuilder().token(conf['bot_token']).build()
+    app.add_handler(TypeHandler(Update, route))
+    try:
+        if supervisor_conf.get('ingest', 'polling') == 'webhook':
+            RunWebhook(app, conf.get('webhook', {}))
+        else:
+            app.run_polling()
+    finally:
+        stopping.set()
+        watcher.join()
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join(supervisor_conf.get('shutdown_timeout', 30))
+            if process.is_alive():
+                logging.error("[SUPERVISOR] Worker %s did not stop in time, terminating", process.name)
+                process.terminate()
 
+if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         prog = 'YSDB', description = '''Your self-discipline bot''', epilog = '''(c) 2024''')   
 
 
     parser.add_argument ('--conf', dest='conf', action="store", type=str, required=True)
+    parser.add_argument ('--mode', dest='mode', action="store", type=str, default='polling', choices=['polling', 'webhook', 'supervisor'])
 
     args = parser.parse_args()
 
@@ -411,19 +696,11 @@ if __name__ == '__main__':
     with open(args.conf, 'r') as file:
         conf = json.load(file)
 
-    db = DbWorkerService(conf['db'])
-
-    app = ApplicationBuilder().token(conf['bot_token']).build()
-
-    bot = YSDBot(db)
-
-    app.add_handler(CommandHandler("status", bot.status))
-    app.add_handler(CommandHandler("push", bot.push))
-    app.add_handler(CommandHandler("pop", bot.pop))
-    app.add_handler(CommandHandler("mystat", bot.mystat))
-    app.add_handler(CommandHandler("stat", bot.stat))
-    app.add_handler(CommandHandler("top", bot.top))
-    app.add_error_handler(bot.error_handler)
-
-    app.run_polling()
-
+    log_listener = SetupLogging(conf.get('logging', {}))
+    try:
+        if args.mode == 'supervisor':
+            RunSupervisor(conf)
+        else:
+            Run(conf, args.mode)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,106 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s'
+TEXT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Lazy log argument describing the update being handled. Nothing is formatted until a record
+# passes the level check, and then only on the listener thread. JsonFormatter also takes its
+# fields as separate keys
+class UpdateFields:
+    __slots__ = ("Update", "Command")
+
+    def __init__(self, update, command:str):
+        self.Update = update
+        self.Command = command
+
+    def Fields(self) -> dict:
+        result = {"command": self.Command}
+        user = self.Update.effective_user
+        if not (user is None):
+            result["user_id"] = user.id
+            result["user"] = user.name
+        chat = self.Update.effective_chat
+        if not (chat is None):
+            result["chat_id"] = chat.id
+            result["chat"] = chat.effective_name
+        message = self.Update.effective_message
+        if not (message is None) and not (message.text is None):
+            result["text"] = message.text
+        return result
+
+    def __str__(self) -> str:
+        fields = self.Fields()
+        result = "user id ["+str(fields.get("user_id"))+"]{"+str(fields.get("user"))+"}"
+        result += ", chat id ["+str(fields.get("chat_id"))+"]{"+str(fields.get("chat"))+"}"
+        if "text" in fields:
+            result += ", text: "+fields["text"]
+        return result
+
+# One JSON object per line. Structured fields come from UpdateFields arguments and from
+# extra={"fields": {...}}
+class JsonFormatter(logging.Formatter):
+    def format(self, record:logging.LogRecord) -> str:
+        result = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "func": record.funcName,
+            "message": record.getMessage()
+        }
+        if isinstance(record.args, tuple):
+            for arg in record.args:
+                if isinstance(arg, UpdateFields):
+                    result.update(arg.Fields())
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            result.update(fields)
+        if record.exc_info:
+            result["exception"] = self.formatException(record.exc_info)
+        return json.dumps(result, ensure_ascii=False, default=str)
+
+# Hands records to the listener thread as they are: no formatting on the caller's thread, and
+# a full queue drops the record instead of blocking
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue:queue.Queue):
+        super().__init__(log_queue)
+        self.Dropped = 0
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record:logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.Dropped += 1
+
+# config: the "logging" section of conf.json. Replaces the root handlers with a queue handler;
+# records are written by the returned listener's thread. Call listener.stop() on exit to flush
+def SetupLogging(config:dict) -> logging.handlers.QueueListener:
+    if len(config.get("file", "")) > 0:
+        output = logging.FileHandler(config["file"], encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    if config.get("format", "text") == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+
+    handler = NonBlockingQueueHandler(queue.Queue(config.get("queue_size", 10000)))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(config.get("level", "WARNING"))
+    for name, level in config.get("levels", {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+import psycopg2
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "db"))
+
+# "db" section of the conf.json named by YSDB_TEST_CONF. It must point to a throwaway database
+# created with dbtool.py: the bot tables are truncated before every test that uses it
+@pytest.fixture
+def db_config() -> dict:
+    path = os.environ.get("YSDB_TEST_CONF", "")
+    if len(path) < 1:
+        pytest.skip("YSDB_TEST_CONF is not set")
+    with open(path, "r") as f:
+        config = json.load(f)["db"]
+    conn = psycopg2.connect(user=config["username"], password=config["password"], host=config["host"],
+        port=config["port"], database=config["db"])
+    cursor = conn.cursor()
+    cursor.execute("TRUNCATE self_contrib_record, daily_contrib_rollup, user_chat_totals, chat, sd_user CASCADE")
+    conn.commit()
+    conn.close()
+    config["replica"] = {}
+    config["write_behind"] = {"enabled": False}
+    return config
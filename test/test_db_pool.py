@@ -0,0 +1,166 @@
+import threading
+import time
+import psycopg2.extensions
+import pytest
+from db_pool import ManagedConnectionPool
+from ysdb_exception import YSDBException
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.Connection = conn
+
+    def execute(self, query, params = None) -> None:
+        if self.Connection.Dead:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def fetchall(self) -> list:
+        return [(1, )]
+
+class FakeInfo:
+    def __init__(self):
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class FakeConnection:
+    def __init__(self, number:int):
+        self.Number = number
+        self.closed = 0
+        self.Dead = False
+        self.info = FakeInfo()
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def rollback(self) -> None:
+        if self.Dead:
+            raise psycopg2.OperationalError("connection already closed")
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self) -> None:
+        self.closed = 1
+
+class FakeConnect:
+    def __init__(self):
+        self.Connections:list[FakeConnection] = []
+
+    def __call__(self) -> FakeConnection:
+        conn = FakeConnection(len(self.Connections))
+        self.Connections.append(conn)
+        return conn
+
+def make_pool(**config) -> tuple[ManagedConnectionPool, FakeConnect]:
+    connect = FakeConnect()
+    config.setdefault("min", 0)
+    return ManagedConnectionPool(connect, config), connect
+
+def test_opens_up_to_max_and_reuses():
+    pool, connect = make_pool(min=1, max=2)
+    assert len(connect.Connections) == 1
+    a = pool.getconn()
+    b = pool.getconn()
+    assert len(connect.Connections) == 2
+    pool.putconn(a)
+    assert pool.getconn() is a
+    pool.putconn(a)
+    pool.putconn(b)
+    assert pool.GetStats()["idle"] == 2
+    assert pool.GetStats()["in_use"] == 0
+
+def test_wait_timeout():
+    pool, connect = make_pool(max=1, wait_timeout=0.1)
+    pool.getconn()
+    start = time.monotonic()
+    with pytest.raises(YSDBException):
+        pool.getconn()
+    assert time.monotonic() - start >= 0.1
+    assert pool.GetStats()["timeouts"] == 1
+    assert pool.GetStats()["waiting"] == 0
+
+def test_waiter_gets_returned_connection():
+    pool, connect = make_pool(max=1, wait_timeout=5)
+    conn = pool.getconn()
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(pool.getconn()))
+    waiter.start()
+    while pool.GetStats()["waiting"] < 1:
+        time.sleep(0.01)
+    pool.putconn(conn)
+    waiter.join()
+    assert result == [conn]
+
+def test_max_waiting_rejection():
+    pool, connect = make_pool(max=1, max_waiting=1, wait_timeout=5)
+    conn = pool.getconn()
+    waiter = threading.Thread(target=pool.getconn)
+    waiter.start()
+    while pool.GetStats()["waiting"] < 1:
+        time.sleep(0.01)
+    start = time.monotonic()
+    with pytest.raises(YSDBException):
+        pool.getconn()
+    # rejected at once instead of waiting for wait_timeout
+    assert time.monotonic() - start < 1.0
+    assert pool.GetStats()["rejected"] == 1
+    pool.putconn(conn)
+    waiter.join()
+
+def test_closed_idle_connection_is_replaced():
+    pool, connect = make_pool(min=1, max=1)
+    connect.Connections[0].closed = 1
+    conn = pool.getconn()
+    assert conn is connect.Connections[1]
+    assert pool.GetStats()["discarded"] == 1
+
+def test_dead_idle_connection_is_replaced_after_ping():
+    pool, connect = make_pool(min=1, max=1, check_idle_after=0)
+    time.sleep(0.01)
+    connect.Connections[0].Dead = True
+    conn = pool.getconn()
+    assert conn is connect.Connections[1]
+    assert connect.Connections[0].closed
+    assert pool.GetStats()["discarded"] == 1
+
+def test_broken_connection_is_discarded_on_return():
+    pool, connect = make_pool(max=2)
+    conn = pool.getconn()
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    conn.Dead = True
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.GetStats()["idle"] == 0
+    assert pool.GetStats()["discarded"] == 1
+
+def test_open_transaction_is_rolled_back_on_return():
+    pool, connect = make_pool(max=1)
+    conn = pool.getconn()
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert not conn.closed
+    assert pool.getconn() is conn
+    assert conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+def test_old_connection_is_discarded():
+    pool, connect = make_pool(max=1, max_age=0)
+    conn = pool.getconn()
+    time.sleep(0.01)
+    pool.putconn(conn)
+    assert conn.closed
+    assert not (pool.getconn() is conn)
+
+def test_failed_open_frees_the_slot():
+    attempts = []
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise psycopg2.OperationalError("could not connect to server")
+        return FakeConnection(len(attempts))
+    pool = ManagedConnectionPool(connect, {"min": 0, "max": 1, "wait_timeout": 0.1})
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+    assert pool.getconn().Number == 2
+
+def test_closeall():
+    pool, connect = make_pool(min=2, max=2)
+    pool.closeall()
+    assert all([conn.closed for conn in connect.Connections])
+    with pytest.raises(YSDBException):
+        pool.getconn()
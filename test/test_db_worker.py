@@ -0,0 +1,28 @@
+import threading
+from datetime import datetime
+from db_worker import DbWorkerService
+
+# Concurrent pushes of one user wait for each other on the advisory lock; rows committed while
+# a push waits must count towards its daily limit
+def test_push_limit_holds_under_concurrency(db_config):
+    db_config["pool"] = {"min": 1, "max": 20, "wait_timeout": 30}
+    db = DbWorkerService(db_config)
+    barrier = threading.Barrier(20)
+    accepted = []
+
+    def push():
+        barrier.wait()
+        result = db.PushContribution(1, "user 1", -1, "chat 1", 10000, 100000, datetime.now())
+        accepted.append(result.Accepted)
+
+    try:
+        threads = [threading.Thread(target=push) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        db.Close()
+
+    # a push passes while the day's sum before it is at most the limit: 0, 10000, ..., 100000
+    assert accepted.count(True) == 11
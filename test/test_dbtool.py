@@ -0,0 +1,104 @@
+import argparse
+import psycopg2.errors
+import pytest
+from dbtool import split_sql, file_directives, drop_invalid_index, execute_online_statement
+
+def statements(text:str) -> list[str]:
+    return [statement for statement, directives in split_sql(text)]
+
+def test_split_on_semicolons():
+    assert statements("SELECT 1; SELECT 2;\n\nSELECT 3") == ["SELECT 1", "SELECT 2", "SELECT 3"]
+
+def test_semicolons_in_strings():
+    assert statements("INSERT INTO t VALUES ('a;b', 'it''s;'); SELECT \"odd;name\" FROM t;") == [
+        "INSERT INTO t VALUES ('a;b', 'it''s;')", "SELECT \"odd;name\" FROM t"]
+
+def test_semicolons_in_dollar_quotes():
+    text = "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; SELECT $$x;$$; $body$ LANGUAGE sql; DO $$ BEGIN NULL; END $$;"
+    assert statements(text) == [
+        "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; SELECT $$x;$$; $body$ LANGUAGE sql",
+        "DO $$ BEGIN NULL; END $$"]
+
+def test_semicolons_in_comments():
+    text = "SELECT 1 -- not; a split\n; /* nor; this */ SELECT 2;"
+    assert statements(text) == ["SELECT 1 -- not; a split", "/* nor; this */ SELECT 2"]
+
+def test_comment_only_chunks_are_skipped():
+    assert statements("SELECT 1;\n-- the end\n;/* nothing */;") == ["SELECT 1"]
+
+def test_directives_attach_to_the_following_statement():
+    text = """-- ysdb: no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON t (a);
+  -- ysdb: batch
+UPDATE t SET b = a WHERE id IN (SELECT id FROM t WHERE b IS NULL LIMIT 10);
+SELECT 1;
+"""
+    assert [directives for statement, directives in split_sql(text)] == [{"no-transaction"}, {"batch"}, set()]
+    assert file_directives(text) == {"no-transaction", "batch"}
+
+def test_directive_like_text_is_ignored():
+    text = """SELECT 1; -- ysdb: batch
+UPDATE t SET b = a
+-- ysdb: batch
+WHERE b IS NULL;
+CREATE FUNCTION f() RETURNS int AS $$
+-- ysdb: no-transaction
+SELECT 1 $$ LANGUAGE sql;
+SELECT '
+-- ysdb: batch
+';"""
+    assert [directives for statement, directives in split_sql(text)] == [set(), set(), set(), set()]
+    assert file_directives(text) == set()
+
+class FakeCursor:
+    def __init__(self, invalid_indexes:set[str], lock_failures:int = 0):
+        self.InvalidIndexes = invalid_indexes
+        self.LockFailures = lock_failures
+        self.Executed:list[str] = []
+        self.Row = None
+        self.rowcount = 0
+
+    def execute(self, query:str, params = None) -> None:
+        self.Executed.append(query if params is None else query % tuple([repr(p) for p in params]))
+        if query.startswith("SELECT NOT i.indisvalid"):
+            self.Row = (True, ) if params[0] in self.InvalidIndexes else None
+        elif query.startswith("DROP INDEX CONCURRENTLY IF EXISTS "):
+            self.InvalidIndexes.discard(query.split(" ")[-1])
+        elif query.startswith("CREATE INDEX CONCURRENTLY"):
+            name = query.split(" ")[-4]
+            if self.LockFailures > 0:
+                self.LockFailures -= 1
+                self.InvalidIndexes.add(name)
+                raise psycopg2.errors.LockNotAvailable("canceling statement due to lock timeout")
+            if name in self.InvalidIndexes:
+                raise psycopg2.errors.DuplicateTable("relation already exists")
+
+    def fetchone(self):
+        return self.Row
+
+def make_args(lock_retries:int = 3) -> argparse.Namespace:
+    return argparse.Namespace(lock_timeout="5s", lock_retries=lock_retries, retry_delay=0, batch_pause=0)
+
+def test_drop_invalid_index():
+    cursor = FakeCursor({"idx_a"})
+    drop_invalid_index(cursor, "idx_a", make_args())
+    assert cursor.InvalidIndexes == set()
+    # dropped without lock_timeout, which is restored afterwards
+    assert cursor.Executed[1:] == ["SET lock_timeout = 0", "DROP INDEX CONCURRENTLY IF EXISTS idx_a", "SET lock_timeout = '5s'"]
+
+def test_valid_or_missing_index_is_kept():
+    cursor = FakeCursor(set())
+    drop_invalid_index(cursor, "idx_a", make_args())
+    assert len(cursor.Executed) == 1
+
+def test_concurrent_index_is_retried_after_lock_timeout():
+    cursor = FakeCursor(set(), 2)
+    execute_online_statement(cursor, "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON t (a)", set(), make_args())
+    assert cursor.InvalidIndexes == set()
+    assert cursor.Executed.count("DROP INDEX CONCURRENTLY IF EXISTS idx_a") == 2
+
+def test_invalid_index_is_dropped_when_retries_run_out():
+    cursor = FakeCursor(set(), 5)
+    with pytest.raises(psycopg2.errors.LockNotAvailable):
+        execute_online_statement(cursor, "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON t (a)", set(), make_args(1))
+    assert cursor.InvalidIndexes == set()
@@ -0,0 +1,40 @@
+from datetime import datetime
+from leaderboards import Leaderboard, LeaderboardStore
+
+MONTH = datetime(2026, 10, 1)
+
+def make_store() -> LeaderboardStore:
+    store = LeaderboardStore({"interval": 300, "windows": [0, 30]})
+    store.Retain({-1, -2})
+    return store
+
+def test_board_is_served_until_the_chat_is_written():
+    store = make_store()
+    store.Put(-1, 30, Leaderboard([], datetime(2026, 10, 18), 5, MONTH))
+    assert not (store.Get(-1, 30, 5, MONTH) is None)
+    assert store.Get(-1, 30, 6, MONTH) is None
+    # dropped, not served again with the old generation
+    assert store.Get(-1, 30, 5, MONTH) is None
+
+def test_current_month_board_from_another_month_is_not_served():
+    store = make_store()
+    store.Put(-1, 0, Leaderboard([], datetime(2026, 9, 30, 23, 59), 5, datetime(2026, 9, 1)))
+    store.Put(-1, 30, Leaderboard([], datetime(2026, 9, 30, 23, 59), 5, datetime(2026, 9, 1)))
+    assert store.Get(-1, 0, 5, MONTH) is None
+    assert not (store.Get(-1, 30, 5, MONTH) is None)
+
+def test_refresh_is_scheduled_once_per_active_chat():
+    store = make_store()
+    assert store.ScheduleRefresh(-1)
+    assert not store.ScheduleRefresh(-1)
+    assert not store.ScheduleRefresh(-3)
+    store.PendingChats.discard(-1)
+    assert store.ScheduleRefresh(-1)
+
+def test_retain_drops_inactive_chats():
+    store = make_store()
+    store.Put(-1, 30, Leaderboard([], datetime(2026, 10, 18), 5, MONTH))
+    store.Put(-2, 30, Leaderboard([], datetime(2026, 10, 18), 5, MONTH))
+    store.Retain({-2})
+    assert list(store.Boards.keys()) == [(-2, 30)]
+    assert not store.ScheduleRefresh(-1)
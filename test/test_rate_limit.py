@@ -0,0 +1,90 @@
+from rate_limit import BucketMap, CommandLimits, MakeCommandLimits, MakeLimit
+
+class FakeClock:
+    def __init__(self):
+        self.Now = 1000.0
+
+    def __call__(self) -> float:
+        return self.Now
+
+def make_limits(clock:FakeClock, max_size:int = 100) -> CommandLimits:
+    config = {"global": {"rate": 100.0, "burst": 100.0}, "chat": MakeLimit(1.0, 2.0), "user": MakeLimit(1.0, 2.0)}
+    return CommandLimits(config, max_size, clock)
+
+def test_burst_then_rejection():
+    limits = make_limits(FakeClock())
+    assert not limits.Check(1, -1)
+    assert not limits.Check(1, -1)
+    assert limits.Check(1, -1)
+
+def test_rejected_command_takes_no_tokens():
+    clock = FakeClock()
+    limits = make_limits(clock)
+    limits.Check(1, -1)
+    limits.Check(1, -1)
+    assert limits.Check(2, -1)
+    # user 2 was rejected by the chat bucket and still has its whole burst
+    assert not limits.Check(2, -2)
+    assert not limits.Check(2, -3)
+    assert limits.Check(2, -4)
+
+def test_refill():
+    clock = FakeClock()
+    limits = make_limits(clock)
+    limits.Check(1, -1)
+    limits.Check(1, -1)
+    clock.Now += 0.5
+    assert limits.Check(1, -1)
+    clock.Now += 0.5
+    assert not limits.Check(1, -1)
+    assert limits.Check(1, -1)
+
+def test_refill_is_capped_by_burst():
+    clock = FakeClock()
+    limits = make_limits(clock)
+    clock.Now += 100.0
+    assert not limits.Check(1, -1)
+    assert not limits.Check(1, -1)
+    assert limits.Check(1, -1)
+
+def test_global_bucket():
+    limits = CommandLimits({"global": MakeLimit(1.0), "chat": MakeLimit(0.01, 10.0), "user": MakeLimit(0.01, 10.0)}, 100, FakeClock())
+    assert not limits.Check(1, -1)
+    assert limits.Check(2, -2)
+
+def test_idle_buckets_are_evicted():
+    buckets = BucketMap(1.0, 2.0, 100)
+    buckets.Get(1, 0.0)
+    buckets.Get(2, 1.0)
+    assert len(buckets) == 2
+    # bucket 1 has been idle for Burst/Rate seconds, i.e. it is full again
+    buckets.Get(3, 2.0)
+    assert list(buckets.Buckets.keys()) == [2, 3]
+
+def test_max_size_evicts_least_recently_used():
+    buckets = BucketMap(1.0, 2.0, 3)
+    for key in [1, 2, 3]:
+        buckets.Get(key, 0.0)
+    buckets.Get(1, 0.1)
+    buckets.Get(4, 0.2)
+    assert len(buckets) == 3
+    assert list(buckets.Buckets.keys()) == [3, 1, 4]
+
+def test_evicted_user_starts_with_full_burst():
+    clock = FakeClock()
+    limits = make_limits(clock, 2)
+    limits.Check(1, -1)
+    limits.Check(1, -1)
+    limits.Check(2, -2)
+    limits.Check(3, -3)
+    assert limits.TrackedCount() == 4
+    assert not (1 in limits.Users.Buckets)
+    # a fresh bucket: the burst is available again even without refill time
+    assert not limits.Check(1, -4)
+
+def test_config_overrides_defaults():
+    limits = MakeCommandLimits({"max_tracked_ids": 7, "push": {"user": {"burst": 3}}}, "push")
+    assert limits.Users.Burst == 3
+    assert limits.Users.Rate == 2.0
+    assert limits.Users.MaxSize == 7
+    assert limits.Chats.Burst == 1.0
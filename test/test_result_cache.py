@@ -0,0 +1,88 @@
+from result_cache import ResultCache
+from db_worker import DbWorkerService
+
+class FakeClock:
+    def __init__(self):
+        self.Now = 1000.0
+
+    def __call__(self) -> float:
+        return self.Now
+
+def put(cache:ResultCache, chat_id:int, command:str, window:int, value) -> None:
+    cache.Put(chat_id, command, window, value, cache.Begin(chat_id))
+
+def test_get_put():
+    cache = ResultCache(10.0, 100, FakeClock())
+    assert cache.Get(-1, "top", 30) is None
+    put(cache, -1, "top", 30, "top -1")
+    assert cache.Get(-1, "top", 30) == "top -1"
+    assert cache.Get(-1, "top", 7) is None
+    assert cache.Hits == 1
+    assert cache.Misses == 2
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = ResultCache(10.0, 100, clock)
+    put(cache, -1, "stat", 7, "stat -1")
+    clock.Now += 9.0
+    assert cache.Get(-1, "stat", 7) == "stat -1"
+    clock.Now += 2.0
+    assert cache.Get(-1, "stat", 7) is None
+    assert len(cache.Items) == 0
+    assert len(cache.ChatKeys) == 0
+
+def test_invalidate_chat_keeps_other_chats():
+    cache = ResultCache(10.0, 100, FakeClock())
+    for chat_id in [-1, -2]:
+        put(cache, chat_id, "top", 30, "top "+str(chat_id))
+        put(cache, chat_id, "stat", 7, "stat "+str(chat_id))
+    cache.InvalidateChat(-1)
+    assert cache.Get(-1, "top", 30) is None
+    assert cache.Get(-1, "stat", 7) is None
+    assert cache.Get(-2, "top", 30) == "top -2"
+    assert cache.Get(-2, "stat", 7) == "stat -2"
+
+def test_put_after_write_is_skipped():
+    cache = ResultCache(10.0, 100, FakeClock())
+    generation = cache.Begin(-1)
+    # a write lands while the result is being computed
+    cache.InvalidateChat(-1)
+    cache.Put(-1, "top", 30, "stale", generation)
+    assert cache.Get(-1, "top", 30) is None
+    put(cache, -1, "top", 30, "fresh")
+    assert cache.Get(-1, "top", 30) == "fresh"
+
+def test_stripe_collision_only_skips_put():
+    cache = ResultCache(10.0, 100, FakeClock())
+    other = -1 - ResultCache.GENERATION_STRIPES
+    put(cache, other, "top", 30, "top other")
+    generation = cache.Begin(other)
+    cache.InvalidateChat(-1)
+    cache.Put(other, "stat", 7, "stat other", generation)
+    assert cache.Get(other, "stat", 7) is None
+    assert cache.Get(other, "top", 30) == "top other"
+
+def test_max_size_evicts_least_recently_used():
+    cache = ResultCache(10.0, 2, FakeClock())
+    put(cache, -1, "top", 30, "a")
+    put(cache, -2, "top", 30, "b")
+    cache.Get(-1, "top", 30)
+    put(cache, -3, "top", 30, "c")
+    assert cache.Get(-2, "top", 30) is None
+    assert cache.Get(-1, "top", 30) == "a"
+    assert not (-2 in cache.ChatKeys)
+
+# Records committed by the write-behind queue drop the cached results of their chats only
+def test_written_records_invalidate_their_chats():
+    db = DbWorkerService({"username": "", "password": "", "host": "", "port": 0, "db": "", "pool": {"min": 0}})
+    for chat_id in [-1, -2]:
+        put(db.ResultCache, chat_id, "top", 30, "top "+str(chat_id))
+        put(db.ResultCache, chat_id, "stat", 7, "stat "+str(chat_id))
+    db.OnRecordsWritten({-1})
+    assert db.ResultCache.Get(-1, "top", 30) is None
+    assert db.ResultCache.Get(-1, "stat", 7) is None
+    assert db.ResultCache.Get(-2, "top", 30) == "top -2"
+    assert db.ResultCache.Get(-2, "stat", 7) == "stat -2"
+    assert db.IsPinned({"chat_id": -1})
+    assert not db.IsPinned({"chat_id": -2})
+    db.Close()
@@ -0,0 +1,84 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from telegram import Chat, Message, Update
+from update_processor import ChatOrderedUpdateProcessor
+
+def make_update(update_id:int, chat_id:int) -> Update:
+    chat = Chat(chat_id, Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), chat, text="/stat"))
+
+def test_updates_of_a_chat_are_processed_in_order():
+    async def run() -> tuple[dict[int, list[int]], dict[int, list[int]], int]:
+        processor = ChatOrderedUpdateProcessor(4)
+        arrived:dict[int, list[int]] = {-1: [], -2: []}
+        processed:dict[int, list[int]] = {-1: [], -2: []}
+        running:dict[int, int] = {-1: 0, -2: 0}
+        max_running = 0
+
+        async def handle(update_id:int, chat_id:int) -> None:
+            nonlocal max_running
+            running[chat_id] += 1
+            max_running = max(max_running, running[chat_id])
+            await asyncio.sleep(random.random()*0.01)
+            processed[chat_id].append(update_id)
+            running[chat_id] -= 1
+
+        tasks = []
+        for update_id in range(40):
+            chat_id = random.choice([-1, -2])
+            arrived[chat_id].append(update_id)
+            tasks.append(asyncio.create_task(
+                processor.process_update(make_update(update_id, chat_id), handle(update_id, chat_id))))
+        await asyncio.gather(*tasks)
+        assert processor.ChatLocks == {}
+        assert processor.InFlight == 0
+        return arrived, processed, max_running
+
+    random.seed(1)
+    arrived, processed, max_running = asyncio.run(run())
+    assert processed == arrived
+    assert max_running == 1
+
+# Updates queued behind a busy chat must not hold concurrency slots other chats could use
+def test_waiting_updates_hold_no_slots():
+    async def run() -> bool:
+        processor = ChatOrderedUpdateProcessor(2)
+        release = asyncio.Event()
+
+        async def blocked() -> None:
+            await release.wait()
+
+        async def free() -> None:
+            pass
+
+        busy = [asyncio.create_task(processor.process_update(make_update(i, -1), blocked())) for i in range(5)]
+        other = asyncio.create_task(processor.process_update(make_update(5, -2), free()))
+        try:
+            await asyncio.wait_for(asyncio.shield(other), 1.0)
+            done = True
+        except asyncio.TimeoutError:
+            done = False
+        release.set()
+        await asyncio.gather(other, *busy)
+        return done
+
+    assert asyncio.run(run())
+
+def test_updates_without_chat_are_not_serialized():
+    async def run() -> int:
+        processor = ChatOrderedUpdateProcessor(4)
+        running = 0
+        max_running = 0
+
+        async def handle() -> None:
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*[processor.process_update(object(), handle()) for i in range(8)])
+        return max_running
+
+    assert asyncio.run(run()) == 4